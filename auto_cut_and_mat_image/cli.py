@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+BatchCut 命令行批处理
+不打开界面，批量截头或抠图，结果写入单独的输出目录（保持输入目录结构），结束时输出吞吐量统计。
+可以在没有显示器的服务器上运行；输出目录中的任务日志让中断后重新运行时跳过已完成的图片。
+
+用法: batchcut crop 输入目录 --out 输出目录 [--workers N] [--threads-per-worker M]
+      batchcut matte 输入目录 --out 输出目录 [--workers N] [--threads-per-worker M] [--tier full|lite] [--tol 0.002]
+      batchcut serve [--port 8765] [--max-batch 8] [--max-wait-ms 10]   # 本机抠图 HTTP 服务
+也可以直接运行 python cli.py crop|matte ...
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import cv2
+
+import engine_lazy as engine
+import job_journal
+import matting_pool
+import pipeline
+import processing
+import server
+
+# 多进程截头时每个工作进程各自的人脸检测网络
+_worker_net = None
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def parse_dpi(text):
+    return tuple(map(int, text.split(",")))
+
+
+def collect_inputs(input_path):
+    """返回 (输入根目录, 图片列表)；输入可以是目录或单个文件"""
+    if os.path.isdir(input_path):
+        return input_path, sorted(processing.list_image_files(input_path))
+    return os.path.dirname(input_path) or ".", [input_path]
+
+
+def _init_crop_worker(threads):
+    global _worker_net
+    if threads:
+        cv2.setNumThreads(threads)
+    _worker_net = processing.load_face_net()
+
+
+def _crop_task(task):
+    image_path, output_path, target_width, target_height, dpi, confidence, cut_percentage = task
+    input_hash = None
+    try:
+        input_hash = job_journal.file_digest(image_path)
+        processing.crop_file(_worker_net, image_path, target_width, target_height, dpi,
+                             confidence, cut_percentage, output_path)
+        status, error = "ok", None
+    except Exception as e:
+        status, error = "failed", f"{type(e).__name__}: {e}"
+    return {"path": image_path, "status": status, "error": error, "input_hash": input_hash}
+
+
+def _pipeline_results(image_files, outputs, decode, infer, save, batch_size=1, infer_workers=1):
+    """用流水线处理，把结果转换成与工作池相同的字典；save 的返回值作为抠图轮数"""
+    def finish(image_path, inferred):
+        # 输出写到其他目录，原图不变，保存前后计算哈希都可以
+        input_hash = job_journal.file_digest(image_path)
+        passes_used = save(inferred, image_path, outputs[image_path])
+        return input_hash, passes_used
+
+    results = pipeline.run_pipeline(
+        image_files, decode, infer, finish, decode_workers=max(2, infer_workers), infer_workers=infer_workers,
+        encode_workers=max(2, infer_workers), decode_depth=max(8, 2 * batch_size), batch_size=batch_size
+    )
+    for image_path, finished, error in results:
+        input_hash, passes_used = finished if error is None else (None, None)
+        yield {
+            "path": image_path,
+            "status": "ok" if error is None else "failed",
+            "error": None if error is None else f"{type(error).__name__}: {error}",
+            "input_hash": input_hash,
+            "passes": passes_used,
+        }
+
+
+def run_crop(args, image_files, outputs):
+    target_width, target_height = args.size
+    cut_percentage = args.cut_percentage / 100
+
+    if args.workers > 1:
+        tasks = [
+            (image_path, outputs[image_path], target_width, target_height, args.dpi,
+             args.confidence, cut_percentage)
+            for image_path in image_files
+        ]
+        threads = args.threads_per_worker or matting_pool.default_threads_per_worker(args.workers)
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(args.workers, initializer=_init_crop_worker, initargs=(threads,)) as pool:
+            yield from pool.imap_unordered(_crop_task, tasks, chunksize=1)
+        return
+
+    # 单进程时用多个线程检测，每个线程持有自己的检测网络
+    threads = args.threads_per_worker or os.cpu_count() or 1
+
+    def detect(sources):
+        return list(zip(sources, processing.detect_sources(processing.thread_face_net(), sources, args.confidence)))
+
+    def save(detected, image_path, output_path):
+        src, face_box = detected
+        final_img = processing.crop_source(src, face_box, target_width, target_height, cut_percentage)
+        processing.save_jpeg(final_img, output_path, args.dpi, quality=100)
+
+    with processing.crop_threads(threads):
+        yield from _pipeline_results(image_files, outputs, processing.read_for_detection, detect, save,
+                                     processing.DETECT_BATCH_SIZE, threads)
+
+
+def run_matte(args, image_files, outputs):
+    target_width, target_height = args.size
+    engine.set_quality_preset(args.preset)
+    engine.set_composite_budget(args.composite_budget_mb * 1024 * 1024 if args.composite_budget_mb else None)
+    if args.cache:
+        engine.set_mask_cache()
+
+    if args.workers > 1:
+        yield from matting_pool.run_matting_pool(
+            image_files, target_width, target_height, args.dpi, workers=args.workers,
+            threads_per_worker=args.threads_per_worker,
+            output_paths=[outputs[image_path] for image_path in image_files], tier=args.tier, tol=args.tol,
+        )
+        return
+
+    if args.threads_per_worker:
+        engine.set_num_threads(args.threads_per_worker)
+
+    def matte(decoded):
+        images, digests = zip(*decoded)
+        results, passes_used = engine.remove_bg_mult_batch(
+            list(images), batch_size=args.batch_size, tol=args.tol, return_passes=True, tier=args.tier,
+            target_size=args.size, source_digests=list(digests),
+        )
+        return list(zip(results, passes_used))
+
+    def save(matted, image_path, output_path):
+        processed_img, passes_used = matted
+        resized_img = processing.resize_matting_result(processed_img, target_width, target_height)
+        processing.save_jpeg(resized_img, output_path, args.dpi)
+        return passes_used
+
+    def decode(image_path):
+        return processing.open_image(image_path, args.size)
+
+    yield from _pipeline_results(image_files, outputs, decode, matte, save, args.batch_size)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="batchcut", description="BatchCut 命令行批处理")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_common(sub):
+        sub.add_argument("input", help="输入图片目录或单个图片文件")
+        sub.add_argument("--out", required=True, help="输出目录，保持与输入目录相同的结构")
+        sub.add_argument("--size", type=parse_size, default=(1350, 1800), help="目标尺寸，如 1350x1800")
+        sub.add_argument("--dpi", type=parse_dpi, default=(300, 300), help="输出 DPI，如 300,300")
+        sub.add_argument("--workers", type=int, default=1, help="工作进程数，1 表示单进程流水线")
+        sub.add_argument("--threads-per-worker", type=int,
+                         help="每个进程的计算线程数，默认平分 CPU 核数；单进程截头时为并行检测的线程数")
+        sub.add_argument("--no-resume", dest="resume", action="store_false",
+                         help="忽略任务日志，重新处理所有图片")
+
+    crop = subparsers.add_parser("crop", help="检测人脸并从下巴位置截头")
+    add_common(crop)
+    crop.add_argument("--confidence", type=float, default=0.5, help="人脸检测置信度阈值")
+    crop.add_argument("--cut-percentage", type=float, default=70, help="截取位置在人脸框中的百分比")
+
+    matte = subparsers.add_parser("matte", help="U2NET 抠图并合成白色背景")
+    add_common(matte)
+    matte.add_argument("--tier", choices=sorted(engine.MODEL_TIERS), default=engine.get_model_tier(), help="模型档位")
+    matte.add_argument("--preset", choices=sorted(engine.QUALITY_PRESETS), default=engine.get_quality_preset(),
+                       help="质量档位: quality 为 4 轮 U2NET，fast 为单轮 + 导向滤波边缘细化")
+    matte.add_argument("--batch-size", type=int, default=8, help="单进程时每批推理的图片数量")
+    matte.add_argument("--tol", type=float,
+                       help="收敛阈值 (0~1)，两轮之间 alpha 的平均变化小于该值时提前停止；默认总是跑满 4 轮")
+    matte.add_argument("--composite-budget-mb", type=int, default=engine.get_composite_budget() // (1024 * 1024),
+                       help="合成时的内存预算 (MB)，超大图片按行条带分块合成；0 表示不限制")
+    matte.add_argument("--no-cache", dest="cache", action="store_false", help="不使用遮罩磁盘缓存")
+
+    serve = subparsers.add_parser("serve", help="启动本机抠图 HTTP 服务")
+    server.add_arguments(serve)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == "serve":
+        return server.serve(args.host, args.port, args.max_batch, args.max_wait_ms, args.tier, args.passes,
+                            args.mode, args.threads, tol=args.tol)
+    args.workers = max(1, args.workers)
+
+    input_root, all_files = collect_inputs(args.input)
+    if not all_files:
+        print(f"错误：没有找到图片 {args.input}")
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+    outputs = {
+        image_path: processing.output_path_for(image_path, input_root, args.out)
+        for image_path in all_files
+    }
+
+    if args.command == "crop":
+        kind, run = "crop", run_crop
+        params = {"size": list(args.size), "dpi": list(args.dpi), "confidence": args.confidence,
+                  "cut_percentage": args.cut_percentage / 100}
+    else:
+        kind, run = "matte", run_matte
+        params = {"size": list(args.size), "dpi": list(args.dpi), "tier": args.tier, "preset": args.preset}
+        if args.tol is not None:
+            params["tol"] = args.tol
+
+    journal = job_journal.JobJournal(job_journal.default_journal_path(args.out))
+    image_files = journal.pending(all_files, kind, params) if args.resume else all_files
+    input_stats = {image_path: job_journal.file_stat(image_path) for image_path in image_files}
+    total = len(image_files)
+    print(f"共 {len(all_files)} 张图片，跳过已完成 {len(all_files) - total} 张，待处理 {total} 张")
+
+    failed = 0
+    # 抠图时统计每种轮数的图片数量
+    passes_counts = {}
+    start = time.perf_counter()
+    report_every = max(1, total // 20)
+    for i, result in enumerate(run(args, image_files, outputs), 1):
+        image_path = result["path"]
+        if result["status"] != "ok":
+            failed += 1
+            print(f"错误：处理 {image_path} 失败: {result['error']}")
+        passes_used = result.get("passes")
+        if passes_used is not None:
+            passes_counts[passes_used] = passes_counts.get(passes_used, 0) + 1
+        journal.record(image_path, kind, params, result["status"], input_stats[image_path],
+                       result["input_hash"], outputs[image_path], result["error"], passes_used)
+        if i % report_every == 0 or i == total:
+            elapsed = time.perf_counter() - start
+            print(f"处理进度: {i}/{total}  {i / elapsed:.2f} 张/秒")
+    journal.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"完成：处理 {total - failed} 张，跳过 {len(all_files) - total} 张，失败 {failed} 张")
+    if total:
+        print(f"耗时 {elapsed:.1f} 秒，吞吐量 {total / elapsed:.2f} 张/秒，平均 {elapsed / total * 1000:.0f} 毫秒/张")
+    if passes_counts:
+        counted = sum(passes_counts.values())
+        mean_passes = sum(p * n for p, n in passes_counts.items()) / counted
+        distribution = "，".join(f"{p} 轮 {n} 张" for p, n in sorted(passes_counts.items()))
+        print(f"抠图轮数：平均 {mean_passes:.2f} 轮（{distribution}），每张图片的轮数记录在任务日志中")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
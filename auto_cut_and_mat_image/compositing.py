@@ -0,0 +1,140 @@
+"""
+uint8 定点合成内核
+用 NumPy 向量化实现抠图结果合成用到的几种混合方式，结果与 PIL 的 C 实现逐像素一致：
+    over_color      遮罩混合到纯色背景 (Image.paste / Image.composite 到纯色背景)
+    over_image      遮罩混合到另一张图像 (Image.composite)
+    premultiply     按 alpha 预乘颜色 (paste 到全透明 RGBA 背景)
+    alpha_composite RGBA 叠加到 RGBA (Image.alpha_composite)
+所有内核都可以传入预先分配的 out 和 work 缓冲区，原地写入，不创建 PIL 中间图像。
+"""
+
+import numpy as np
+from PIL import Image
+
+# Image.alpha_composite 内部使用的定点精度
+_PRECISION_BITS = 7
+
+
+def _div255(x):
+    """原地计算 x / 255 的四舍五入，与 PIL 的 DIV255 相同；x 为 uint16 或更宽的无符号整数数组"""
+    x += 128
+    x += x >> 8
+    x >>= 8
+    return x
+
+
+def _work_buffer(work, shape, dtype=np.uint16):
+    if work is None:
+        return np.empty(shape, dtype=dtype)
+    return work.reshape(shape)
+
+
+def _alpha(alpha):
+    # (H, W) 的遮罩扩展出通道维度，广播到每个颜色通道
+    return alpha[..., np.newaxis] if alpha.ndim == 2 else alpha
+
+
+def over_image(fg, alpha, bg, out=None, work=None):
+    """out = fg * alpha + bg * (1 - alpha)
+
+    fg、bg 为 (H, W, C) uint8，alpha 为 (H, W) uint8；out 可以就是 bg，原地混合。
+    """
+    a = _alpha(alpha)
+    work = _work_buffer(work, fg.shape)
+    np.multiply(fg, a, out=work, dtype=np.uint16)
+    work += np.multiply(bg, 255 - a, dtype=np.uint16)
+    _div255(work)
+    if out is None:
+        out = np.empty(fg.shape, dtype=np.uint8)
+    np.copyto(out, work, casting="unsafe")
+    return out
+
+
+def over_color(fg, alpha, color, out=None, work=None):
+    """out = fg * alpha + color * (1 - alpha)，color 为每个通道的背景值，如白色 (255, 255, 255)"""
+    a = _alpha(alpha)
+    work = _work_buffer(work, fg.shape)
+    np.multiply(fg, a, out=work, dtype=np.uint16)
+    inv = (255 - a).astype(np.uint16)
+    work += inv * np.asarray(color, dtype=np.uint16)
+    _div255(work)
+    if out is None:
+        out = np.empty(fg.shape, dtype=np.uint8)
+    np.copyto(out, work, casting="unsafe")
+    return out
+
+
+def premultiply(color, alpha, out=None, work=None):
+    """out = color * alpha，所有通道（包括 color 自带的 alpha 通道）都乘以遮罩"""
+    work = _work_buffer(work, color.shape)
+    np.multiply(color, _alpha(alpha), out=work, dtype=np.uint16)
+    _div255(work)
+    if out is None:
+        out = np.empty(color.shape, dtype=np.uint8)
+    np.copyto(out, work, casting="unsafe")
+    return out
+
+
+def alpha_composite(dst, src, out=None):
+    """把 RGBA 的 src 叠加到 RGBA 的 dst 上，定点运算与 Image.alpha_composite 相同；out 可以就是 dst"""
+    src_a = src[..., 3].astype(np.uint32)
+    dst_a = dst[..., 3].astype(np.uint32)
+    blend = dst_a * (255 - src_a)
+    outa255 = src_a * 255 + blend
+    # src 完全透明的像素保持 dst 不变，避免除以 0
+    visible = src_a != 0
+    coef1 = np.zeros_like(src_a)
+    np.floor_divide(src_a * (255 * 255 << _PRECISION_BITS), outa255, out=coef1, where=visible)
+    coef2 = (255 << _PRECISION_BITS) - coef1
+
+    rgb = src[..., :3] * coef1[..., np.newaxis] + dst[..., :3] * coef2[..., np.newaxis]
+    rgb += 0x80 << _PRECISION_BITS
+    rgb += rgb >> 8
+    rgb >>= 8 + _PRECISION_BITS
+    alpha = _div255(outa255)
+
+    if out is None:
+        out = np.empty(dst.shape, dtype=np.uint8)
+    result = np.concatenate([rgb, alpha[..., np.newaxis]], axis=-1)
+    np.copyto(out, np.where(visible[..., np.newaxis], result, dst), casting="unsafe")
+    return out
+
+
+def check_parity(size=(97, 61), seed=0):
+    """用随机图像对比各个内核与 PIL 的结果，返回每个内核的最大像素差（都应为 0）"""
+    rng = np.random.RandomState(seed)
+    shape = (size[1], size[0])
+    rgb = rng.randint(0, 256, shape + (3,), dtype=np.uint8)
+    bg = rng.randint(0, 256, shape + (3,), dtype=np.uint8)
+    mask = rng.randint(0, 256, shape, dtype=np.uint8)
+    # 包含完全透明和完全不透明的像素
+    mask[0, :] = 0
+    mask[1, :] = 255
+    rgba_src = np.dstack([rgb, mask])
+    rgba_dst = np.dstack([bg, rng.randint(0, 256, shape, dtype=np.uint8)])
+
+    image = Image.fromarray(rgb, "RGB")
+    mask_img = Image.fromarray(mask, "L")
+
+    white = Image.new("RGB", size, (255, 255, 255))
+    white.paste(image, (0, 0), mask_img)
+    transparent = Image.new("RGBA", size, (0, 0, 0, 0))
+    transparent.paste(image, (0, 0), mask_img)
+    expected = {
+        "over_color": np.asarray(white),
+        "over_image": np.asarray(Image.composite(image, Image.fromarray(bg, "RGB"), mask_img)),
+        "premultiply": np.asarray(transparent),
+        "alpha_composite": np.asarray(
+            Image.alpha_composite(Image.fromarray(rgba_dst, "RGBA"), Image.fromarray(rgba_src, "RGBA"))
+        ),
+    }
+    actual = {
+        "over_color": over_color(rgb, mask, (255, 255, 255)),
+        "over_image": over_image(rgb, mask, bg),
+        "premultiply": premultiply(np.dstack([rgb, np.full(shape, 255, np.uint8)]), mask),
+        "alpha_composite": alpha_composite(rgba_dst, rgba_src),
+    }
+    return {
+        name: int(np.abs(expected[name].astype(np.int16) - actual[name].astype(np.int16)).max())
+        for name in expected
+    }
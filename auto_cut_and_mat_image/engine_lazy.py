@@ -1,60 +1,360 @@
 import numpy as np
 from PIL import Image
-import torch
-from torchvision import transforms
-from u2net import utils, model
+from skimage import transform as sk_transform
 import os
+import copy
+import tempfile
 import threading
 
-# 全局变量存储模型
-_model_pred = None
+import compositing
+import mask_cache
+
+# torch 只在 torch 后端里按需导入，onnx 后端全程不导入 torch
+
+# 全局变量存储模型，按模型档位缓存
+_models = {}
 _model_lock = threading.Lock()
 _model_loading = False
+# 加载后是否把 BatchNorm 折叠进卷积
+_optimize_on_load = True
+# 推理精度: "fp32" 或 "int8"（需要先用 quantize.py 生成量化模型）
+_precision = "fp32"
+# 推理后端: "torch"、"torchscript" 或 "onnx"（需要先用 export_onnx.py 导出模型）
+_backend = "torch"
+# torchscript 后端编译后是否把冻结的模型保存到 ckpt 目录
+_save_compiled = False
+# 默认模型档位，单次调用可以用 tier 参数覆盖
+_model_tier = "full"
+# torch 后端的执行方式: "default" (NCHW fp32)、"channels_last" 或 "bf16" (channels_last + bfloat16 autocast)
+_exec_mode = "default"
+# 推理线程数，None 表示使用各后端的默认值
+_num_threads = None
+# 抠图遮罩磁盘缓存，None 表示不使用缓存
+_mask_cache = None
+# 多次抠图的默认质量档位，见 QUALITY_PRESETS
+_quality_preset = "quality"
+# 合成时的内存预算（字节），超过时按行条带分块合成；None 表示不限制
+_composite_budget = 512 * 1024 * 1024
+# 分块合成结果超过预算时写入的临时目录，None 使用系统临时目录
+_composite_spill_dir = None
+
+PRECISIONS = ("fp32", "int8")
+BACKENDS = ("torch", "torchscript", "onnx")
+EXEC_MODES = ("default", "channels_last", "bf16")
+# remove_bg_mult 的抠图方式: "pil" / "tensor" 为多轮 U2NET，"guided" 为单轮 U2NET + 导向滤波边缘细化
+MATTING_MODES = ("pil", "tensor", "guided")
+# 质量档位对应的抠图方式: quality 为 4 轮 U2NET，fast 只跑 1 轮，模型计算量约为四分之一
+QUALITY_PRESETS = {
+    "quality": "pil",
+    "fast": "guided",
+}
+# 模型档位: (权重文件名前缀, u2net.model 中的类名)
+MODEL_TIERS = {
+    "full": ("u2net", "U2NET"),
+    "lite": ("u2netp", "U2NETP"),
+}
+
+def _resolve_tier(tier=None):
+    tier = tier or _model_tier
+    if tier not in MODEL_TIERS:
+        raise ValueError(f"未知的模型档位: {tier}")
+    return tier
 
-def get_model_path():
+def get_model_path(suffix='.pth', tier=None):
     """获取模型文件路径"""
-    return os.path.join(os.path.dirname(__file__), 'ckpt', 'u2net.pth')
+    name = MODEL_TIERS[_resolve_tier(tier)][0]
+    return os.path.join(os.path.dirname(__file__), 'ckpt', name + suffix)
+
+def get_int8_model_path(tier=None):
+    """INT8 量化模型（TorchScript）的路径"""
+    return get_model_path('_int8.pt', tier)
+
+def get_onnx_model_path(tier=None):
+    """ONNX 模型的路径"""
+    return get_model_path('.onnx', tier)
+
+def get_torchscript_model_path(tier=None):
+    """冻结后的 TorchScript 模型路径"""
+    return get_model_path('_traced.pt', tier)
+
+def set_model_tier(tier):
+    """设置默认模型档位: "full" (U2NET) 或 "lite" (U2NETP)"""
+    global _model_tier
+    _model_tier = _resolve_tier(tier)
+
+def get_model_tier():
+    """当前默认模型档位"""
+    return _model_tier
+
+def set_backend(backend, save_compiled=None):
+    """切换推理后端，下次推理时用新后端重新加载模型
+
+    save_compiled 只对 torchscript 后端有效：为 True 时把编译结果保存到 ckpt 目录，下次直接加载。
+    """
+    global _backend, _save_compiled
+    if backend not in BACKENDS:
+        raise ValueError(f"未知的推理后端: {backend}")
+    with _model_lock:
+        if save_compiled is not None:
+            _save_compiled = save_compiled
+        if backend != _backend:
+            _backend = backend
+            _models.clear()
+
+def get_backend():
+    """当前使用的推理后端"""
+    return _backend
+
+def set_num_threads(num_threads):
+    """限制当前进程推理使用的线程数（torch 和 onnx 后端都有效）"""
+    global _num_threads
+    _num_threads = num_threads
+    if _backend != "onnx":
+        import torch
+        torch.set_num_threads(num_threads)
+
+def set_mask_cache(enabled=True, cache_dir=None, max_bytes=mask_cache.DEFAULT_MAX_BYTES):
+    """开启或关闭 remove_bg_mult 的遮罩磁盘缓存
+
+    命中缓存的图片跳过全部推理，只重新合成；cache_dir 默认为 ~/.cache/auto_cut_and_mat_image/masks，
+    总大小超过 max_bytes 时淘汰最久未使用的遮罩。
+    """
+    global _mask_cache
+    _mask_cache = mask_cache.MaskCache(cache_dir, max_bytes) if enabled else None
+    return _mask_cache
+
+def get_mask_cache():
+    """当前使用的遮罩缓存，未开启时为 None"""
+    return _mask_cache
+
+def _model_id(tier=None):
+    """模型标识：档位、后端、精度、执行方式，以及实际加载的模型文件的大小和修改时间"""
+    tier = _resolve_tier(tier)
+    if _backend == "onnx":
+        path = get_onnx_model_path(tier)
+    elif _precision == "int8":
+        path = get_int8_model_path(tier)
+    else:
+        path = get_model_path(tier=tier)
+    try:
+        st = os.stat(path)
+        stamp = (st.st_size, st.st_mtime_ns)
+    except OSError:
+        stamp = None
+    return (tier, _backend, _precision, _exec_mode, stamp)
+
+def set_quality_preset(preset):
+    """设置 remove_bg_mult 默认的质量档位: "quality" 或 "fast"，单次调用可以用 mode 参数覆盖"""
+    global _quality_preset
+    if preset not in QUALITY_PRESETS:
+        raise ValueError(f"未知的质量档位: {preset}")
+    _quality_preset = preset
+
+def get_quality_preset():
+    """当前默认的质量档位"""
+    return _quality_preset
+
+def set_composite_budget(max_bytes, spill_dir=None):
+    """设置合成的内存预算（字节），None 表示不限制
+
+    输出图像合成时的工作内存超过预算时，遮罩按行条带逐块放大并混合到白色背景上；
+    输出本身也超过预算时写入 spill_dir 中的内存映射文件，由系统按需换出。
+    """
+    global _composite_budget, _composite_spill_dir
+    _composite_budget = max_bytes
+    _composite_spill_dir = spill_dir
+
+def get_composite_budget():
+    """当前的合成内存预算"""
+    return _composite_budget
+
+def get_composite_spill_dir():
+    """超出预算时输出缓冲区溢写的目录，None 表示系统临时目录"""
+    return _composite_spill_dir
+
+def get_precision():
+    """当前的推理精度"""
+    return _precision
+
+def set_precision(precision):
+    """切换推理精度，下次推理时按新精度重新加载模型"""
+    global _precision
+    if precision not in PRECISIONS:
+        raise ValueError(f"未知的推理精度: {precision}")
+    with _model_lock:
+        if precision != _precision:
+            _precision = precision
+            _models.clear()
+
+def set_execution_mode(mode):
+    """切换 torch 后端的执行方式（对当前进程生效），下次推理时重新加载模型"""
+    global _exec_mode
+    if mode not in EXEC_MODES:
+        raise ValueError(f"未知的执行方式: {mode}")
+    with _model_lock:
+        if mode != _exec_mode:
+            _exec_mode = mode
+            _models.clear()
+
+def get_execution_mode():
+    """当前的执行方式"""
+    return _exec_mode
+
+def _apply_execution_mode(net, mode):
+    import torch
+
+    if mode != "default":
+        net = net.to(memory_format=torch.channels_last)
+    return net
 
-def load_model():
+def build_model(optimize=None, tier=None):
+    """从 .pth 权重构建 FP32 推理模型"""
+    import torch
+    from u2net import model
+
+    if optimize is None:
+        optimize = _optimize_on_load
+    model_path = get_model_path(tier=tier)
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"模型文件不存在: {model_path}")
+
+    net = getattr(model, MODEL_TIERS[_resolve_tier(tier)][1])(3, 1)
+    net.load_state_dict(torch.load(model_path, map_location="cpu"))
+    net.eval()
+    # 引擎只使用融合输出 d0，推理时不计算其余侧输出的 sigmoid
+    net.inference_only = True
+    if optimize:
+        optimize_for_inference(net)
+    return net
+
+def _load_int8_model(tier=None):
+    import torch
+
+    model_path = get_int8_model_path(tier)
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"量化模型文件不存在: {model_path}，请先运行 quantize.py")
+    net = torch.jit.load(model_path, map_location="cpu")
+    net.eval()
+    return net
+
+def _load_torchscript_model(tier=None):
+    """加载或编译冻结的 TorchScript 模型"""
+    import torch
+
+    compiled_path = get_torchscript_model_path(tier)
+    weights_path = get_model_path(tier=tier)
+    # 编译产物比权重文件新时才复用，避免权重更新后还在用旧模型
+    if os.path.exists(compiled_path) and (
+        not os.path.exists(weights_path) or os.path.getmtime(compiled_path) >= os.path.getmtime(weights_path)
+    ):
+        net = torch.jit.load(compiled_path, map_location="cpu")
+        net.eval()
+        return net
+
+    net = build_model(tier=tier)
+    with torch.no_grad():
+        traced = torch.jit.trace(net, torch.rand(1, 3, 320, 320))
+    net = torch.jit.freeze(traced.eval())
+    if _save_compiled:
+        torch.jit.save(net, compiled_path)
+        print(f"TorchScript 模型已保存: {compiled_path}")
+    return net
+
+def _load_onnx_session(tier=None):
+    import onnxruntime as ort
+
+    if _precision != "fp32":
+        raise ValueError("onnx 后端只支持 fp32 精度")
+    model_path = get_onnx_model_path(tier)
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"ONNX 模型文件不存在: {model_path}，请先运行 export_onnx.py")
+    options = ort.SessionOptions()
+    if _num_threads:
+        options.intra_op_num_threads = _num_threads
+    return ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+
+def load_model(tier=None):
     """懒加载模型"""
-    global _model_pred, _model_loading
+    global _model_loading
     
-    if _model_pred is not None:
-        return _model_pred
+    tier = _resolve_tier(tier)
+    if tier in _models:
+        return _models[tier]
     
     with _model_lock:
         # 双重检查锁定
-        if _model_pred is not None:
-            return _model_pred
+        if tier in _models:
+            return _models[tier]
             
         if _model_loading:
             # 如果正在加载，等待加载完成
             while _model_loading:
                 threading.Event().wait(0.1)
-            return _model_pred
+            return _models[tier]
         
         _model_loading = True
         try:
-            print("正在加载 U2NET 模型...")
-            model_path = get_model_path()
-            if not os.path.exists(model_path):
-                raise FileNotFoundError(f"模型文件不存在: {model_path}")
-            
-            _model_pred = model.U2NET(3, 1)
-            _model_pred.load_state_dict(torch.load(model_path, map_location="cpu"))
-            _model_pred.eval()
+            print(f"正在加载 U2NET 模型 ({tier}, {_backend}, {_precision}, {_exec_mode})...")
+            if _exec_mode != "default" and (_backend != "torch" or _precision != "fp32"):
+                raise ValueError(f"执行方式 {_exec_mode} 只支持 torch 后端的 fp32 模型")
+            if _backend == "onnx":
+                net = _load_onnx_session(tier)
+            elif _precision == "int8":
+                net = _load_int8_model(tier)
+            elif _backend == "torchscript":
+                net = _load_torchscript_model(tier)
+            else:
+                net = _apply_execution_mode(build_model(tier=tier), _exec_mode)
+            # 全部准备好之后再发布，避免其他线程拿到未优化完的模型
+            _models[tier] = net
             print("U2NET 模型加载完成")
-            return _model_pred
+            return net
         finally:
             _model_loading = False
 
+def register_model(net, tier=None):
+    """直接使用外部已经准备好的模型，例如多进程工作池共享内存中的权重"""
+    with _model_lock:
+        _models[_resolve_tier(tier)] = net
+
+def optimize_for_inference(net=None):
+    """把所有 REBNCONV 的 BatchNorm 折叠进卷积权重（原地修改，可重复调用）"""
+    from u2net import model
+
+    if net is None:
+        net = load_model()
+    net.eval()
+    return model.fuse_conv_bn(net)
+
+def check_fusion_parity(net, inputs=None, atol=1e-4):
+    """对比折叠前后模型的输出，返回 (是否一致, 最大绝对误差)
+
+    net 需要是未折叠的模型，函数内部会复制一份再折叠，不修改 net。
+    """
+    import torch
+
+    if inputs is None:
+        inputs = torch.rand(1, 3, 320, 320)
+    net.eval()
+    fused = optimize_for_inference(copy.deepcopy(net))
+    with torch.no_grad():
+        expected = net(inputs)
+        actual = fused(inputs)
+    if isinstance(expected, tuple):
+        expected, actual = expected[0], actual[0]
+    max_diff = float((expected - actual).abs().max())
+    return max_diff <= atol, max_diff
+
 def norm_pred(d):
-    ma = torch.max(d)
-    mi = torch.min(d)
+    ma = d.max()
+    mi = d.min()
     dn = (d - mi) / (ma - mi)
     return dn
 
 def preprocess(image):
+    from torchvision import transforms
+    from u2net import utils
+
     label_3 = np.zeros(image.shape)
     label = np.zeros(label_3.shape[0:2])
 
@@ -74,80 +374,485 @@ def preprocess(image):
 
     return sample
 
-def remove_bg(image, resize=False):
-    model_pred = load_model()  # 懒加载模型
-    sample = preprocess(np.array(image))
+def preprocess_array(image):
+    """与 preprocess 相同的 RescaleT(320) + ToTensorLab(flag=0)，只用 numpy，返回 (3, 320, 320) float32
+
+    float64 的参考实现，推理热路径使用 preprocess_fast。
+    """
+    if 2 == len(image.shape):
+        image = image[:, :, np.newaxis]
+
+    image = sk_transform.resize(image, (320, 320), mode="constant")
+    image = image / np.max(image)
+
+    tmpImg = np.zeros((image.shape[0], image.shape[1], 3))
+    if image.shape[2] == 1:
+        tmpImg[:, :, 0] = (image[:, :, 0] - 0.485) / 0.229
+        tmpImg[:, :, 1] = (image[:, :, 0] - 0.485) / 0.229
+        tmpImg[:, :, 2] = (image[:, :, 0] - 0.485) / 0.229
+    else:
+        tmpImg[:, :, 0] = (image[:, :, 0] - 0.485) / 0.229
+        tmpImg[:, :, 1] = (image[:, :, 1] - 0.456) / 0.224
+        tmpImg[:, :, 2] = (image[:, :, 2] - 0.406) / 0.225
+
+    return tmpImg.transpose((2, 0, 1)).astype(np.float32)
+
+# ToTensorLab(flag=0) 使用的 ImageNet 均值和方差
+_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32).reshape(1, 3, 1, 1)
+_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32).reshape(1, 3, 1, 1)
+# 灰度图三个通道都用 R 通道的均值和方差
+_GRAY_MEAN = np.full((1, 3, 1, 1), 0.485, dtype=np.float32)
+_GRAY_STD = np.full((1, 3, 1, 1), 0.229, dtype=np.float32)
+_MODEL_SIZE = (320, 320)
+
+def _resize_uint8(image, size=_MODEL_SIZE):
+    """在 uint8 上缩放；RGBA 逐通道缩放，避免 PIL 先按 alpha 预乘"""
+    if image.mode == "RGBA":
+        return Image.merge("RGBA", [band.resize(size, Image.BILINEAR) for band in image.split()])
+    return image.resize(size, Image.BILINEAR)
+
+def preprocess_fast(image, out=None):
+    """推理专用预处理，内部像素与 preprocess_array 在缩放误差范围内一致
+
+    直接在 uint8 上缩放到 320x320，不构造 label，归一化和 HWC→CHW 合并成一次 float32
+    向量运算。image 为 PIL 图像，out 可传入预分配的 (3, 320, 320) float32 数组。
+    边缘的一两行/列有意不同：参考实现的 sk_transform.resize(mode="constant") 在图像外补 0，
+    边缘像素被拉暗（归一化后误差可达 1~2），这里的 PIL 缩放按边缘像素延伸，不复现这种偏差。
+    """
+    if image.mode == "F" or image.mode.startswith("I"):
+        # 16 位 PNG 等高位深图像转成 uint8 会截断到 0-255，按参考实现除以整张图的最大值
+        result = preprocess_array(np.asarray(image))
+        if out is None:
+            return result
+        out[...] = result
+        return out
+
+    if image.mode not in ("L", "RGB", "RGBA"):
+        has_alpha = image.mode in ("LA", "PA", "RGBa", "La") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+    arr = np.asarray(_resize_uint8(image))
+    if arr.ndim == 2:
+        arr = arr[:, :, np.newaxis]
+
+    # ToTensorLab 先除以整张图（包括 alpha 通道）的最大值，再按通道减均值除方差
+    scale = np.float32(1.0 / max(int(arr.max()), 1))
+    if arr.shape[2] == 1:
+        mean, std = _GRAY_MEAN[0], _GRAY_STD[0]
+    else:
+        mean, std = _MEAN[0], _STD[0]
+        arr = arr[:, :, :3]
+
+    if out is None:
+        out = np.empty((3,) + _MODEL_SIZE, dtype=np.float32)
+    np.multiply(arr.transpose(2, 0, 1), scale / std, out=out)
+    out -= mean / std
+    return out
+
+def check_preprocess_parity(image, border=2, atol=0.5):
+    """对比 preprocess_fast 与参考实现的输出，返回 (内部是否一致, 内部最大绝对误差, 边缘最大绝对误差)
+
+    宽度为 border 的边缘有意不同（见 preprocess_fast），只用内部像素和 atol 判断是否一致；
+    atol 为归一化后的误差，不同的缩放插值在内部最多差 0.4 左右，预处理出错时误差通常远大于 1。
+    """
+    expected = preprocess_array(np.array(image))
+    actual = preprocess_fast(image)
+    diff = np.abs(expected - actual)
+    interior = diff[:, border:-border, border:-border]
+    interior_max = float(interior.max())
+    return interior_max <= atol, interior_max, float(diff.max())
+
+def norm_pred_batch(d):
+    """逐张归一化一批预测结果 (N, H, W)"""
+    flat = d.reshape(d.shape[0], -1)
+    ma = flat.max(axis=1).reshape(-1, 1, 1)
+    mi = flat.min(axis=1).reshape(-1, 1, 1)
+    dn = (d - mi) / (ma - mi)
+    return dn
+
+def _run_model(model_pred, inputs):
+    """执行一次前向，输入输出都是 numpy，返回 (N, 320, 320) 的 d0"""
+    if _backend == "onnx":
+        input_name = model_pred.get_inputs()[0].name
+        return model_pred.run(None, {input_name: inputs})[0][:, 0]
+
+    return _run_torch(model_pred, inputs, _exec_mode)
+
+def _run_torch(net, inputs, mode="default"):
+    import torch
 
     with torch.no_grad():
-        inputs_test = torch.FloatTensor(sample["image"].unsqueeze(0).float())
-
-        d1, _, _, _, _, _, _ = model_pred(inputs_test)
-        pred = d1[:, 0, :, :]
-        predict = norm_pred(pred).squeeze().cpu().detach().numpy()
-        img_out = Image.fromarray(predict * 255).convert("RGB")
-        img_out = img_out.resize((image.size), resample=Image.BILINEAR)
-        empty_img = Image.new("RGBA", (image.size), 0)
-        img_out = Image.composite(image, empty_img, img_out.convert("L"))
-        del d1, pred, predict, inputs_test, sample
-
-        return img_out
-
-def _remove(image):
-    model_pred = load_model()  # 懒加载模型
-    sample = preprocess(np.array(image))
-    with torch.no_grad():
-        inputs_test = torch.FloatTensor(sample["image"].unsqueeze(0).float())
-        d1, _, _, _, _, _, _ = model_pred(inputs_test)
-        pred = d1[:, 0, :, :]
-        predict = norm_pred(pred).squeeze().cpu().detach().numpy()
-        mask = Image.fromarray((predict * 255).astype(np.uint8), mode='L')
-        mask = mask.resize(image.size, Image.LANCZOS)
-        
-        # 创建 RGBA 图像
-        img_out = Image.new('RGBA', image.size, (0, 0, 0, 0))
-        img_out.paste(image, (0, 0), mask)
+        x = torch.from_numpy(inputs)
+        if mode != "default":
+            x = x.contiguous(memory_format=torch.channels_last)
+        if mode == "bf16":
+            with torch.autocast("cpu", dtype=torch.bfloat16):
+                d0 = net(x)
+            d0 = d0.float()
+        else:
+            d0 = net(x)
+        return d0[:, 0].numpy()
+
+def check_execution_mode(mode, images=None, tier=None):
+    """用 fp32 NCHW 结果做基准，检查某种执行方式的遮罩差异
+
+    images 为 PIL 图像列表，不传时使用随机输入。返回归一化遮罩的最大和平均绝对误差。
+    """
+    if mode not in EXEC_MODES:
+        raise ValueError(f"未知的执行方式: {mode}")
+    if images:
+        inputs = np.stack([preprocess_fast(img) for img in images])
+    else:
+        inputs = np.random.RandomState(0).randn(2, 3, *_MODEL_SIZE).astype(np.float32)
+
+    net = build_model(tier=tier)
+    expected = norm_pred_batch(_run_torch(net, inputs))
+    net = _apply_execution_mode(copy.deepcopy(net), mode)
+    actual = norm_pred_batch(_run_torch(net, inputs, mode))
+
+    diff = np.abs(expected - actual)
+    report = {"mode": mode, "max_diff": float(diff.max()), "mean_diff": float(diff.mean())}
+    print(f"执行方式 {mode}: 遮罩最大误差 {report['max_diff']:.4f}，平均误差 {report['mean_diff']:.5f}")
+    return report
 
-    return img_out
+def _forward_batch(inputs, batch_size=8, tier=None):
+    """对已归一化的 (N, 3, 320, 320) 输入分组推理，返回 (N, 320, 320) 的归一化预测"""
+    model_pred = load_model(tier)  # 懒加载模型
+    inputs = np.ascontiguousarray(inputs, dtype=np.float32)
+    preds = []
+    for start in range(0, inputs.shape[0], batch_size):
+        d0 = _run_model(model_pred, inputs[start:start + batch_size])
+        preds.append(norm_pred_batch(d0))
+        del d0
 
-def remove_bg_mult(image):
-    # 保存原始图像大小
-    original_size = image.size
+    return np.concatenate(preds)
+
+def _predict_batch(images, batch_size=8, tier=None):
+    """批量推理，按输入顺序返回每张图像 320x320 的归一化预测"""
+    predicts = []
+    for start in range(0, len(images), batch_size):
+        chunk = images[start:start + batch_size]
+        inputs_test = np.empty((len(chunk), 3) + _MODEL_SIZE, dtype=np.float32)
+        for i, img in enumerate(chunk):
+            preprocess_fast(img, out=inputs_test[i])
+        predicts.extend(_forward_batch(inputs_test, batch_size, tier))
+        del inputs_test
+
+    return predicts
+
+def _cutout_rgba(image, mask):
+    """按遮罩把图像贴到全透明背景上，结果为按遮罩预乘的 RGBA，与 paste 到 (0, 0, 0, 0) 相同"""
+    color = np.asarray(image if image.mode == "RGBA" else image.convert("RGBA"))
+    return Image.fromarray(compositing.premultiply(color, np.asarray(mask)), "RGBA")
+
+def _to_rgba(image, predict):
+    img_out = Image.fromarray(predict * 255).convert("RGB")
+    img_out = img_out.resize((image.size), resample=Image.BILINEAR)
+    return _cutout_rgba(image, img_out.convert("L"))
+
+def _paste_rgba(image, predict):
+    mask = Image.fromarray((predict * 255).astype(np.uint8), mode='L')
+    mask = mask.resize(image.size, Image.LANCZOS)
+    return _cutout_rgba(image, mask)
+
+def remove_bg(image, resize=False, tier=None):
+    return _to_rgba(image, _predict_batch([image], tier=tier)[0])
+
+def remove_bg_batch(images, batch_size=8, tier=None):
+    """批量抠图，按输入顺序返回 RGBA 结果"""
+    predicts = _predict_batch(images, batch_size, tier)
+    return [_to_rgba(img, predict) for img, predict in zip(images, predicts)]
+
+def _remove(image, tier=None):
+    return _paste_rgba(image, _predict_batch([image], tier=tier)[0])
+
+def _remove_batch(images, batch_size=8, tier=None):
+    predicts = _predict_batch(images, batch_size, tier)
+    return [_paste_rgba(img, predict) for img, predict in zip(images, predicts)]
+
+_WHITE = (255, 255, 255)
+# 整图合成时每个输出像素大约占用的字节数：缩放后的图像、遮罩、白色背景以及缩放的中间结果
+_COMPOSITE_BYTES_PER_PIXEL = 16
+
+def _composite_white(image, mask, target_size=None):
+    """把遮罩应用到图像上并合成白色背景，返回 RGB 图像
+
+    target_size 为输出尺寸 (宽, 高)，默认为原始图像大小。图像和低分辨率遮罩各自只缩放一次，
+    直接在输出分辨率上合成，不会生成原始分辨率的 RGBA 中间结果。
+    工作内存超过 set_composite_budget 的预算时改为按行条带分块合成。
+    """
+    output_size = tuple(target_size or image.size)
+    if _composite_budget is not None:
+        if output_size[0] * output_size[1] * _COMPOSITE_BYTES_PER_PIXEL > _composite_budget:
+            return _composite_white_tiled(image, mask, output_size, _composite_budget)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if image.size != output_size:
+        image = image.resize(output_size, Image.LANCZOS)
+
+    # 将低分辨率遮罩直接放大到输出大小
+    mask = mask.resize(output_size, Image.LANCZOS)
     
+    # 使用图像和遮罩直接混合到白色背景上
+    out = compositing.over_color(np.asarray(image), np.asarray(mask), _WHITE)
+    return Image.fromarray(out, "RGB")
+
+def _composite_output(output_size, budget):
+    """分块合成的输出缓冲区，超过预算时放在磁盘上的内存映射文件中"""
+    shape = (output_size[1], output_size[0], 3)
+    if budget is not None and shape[0] * shape[1] * 3 > budget:
+        # 临时文件没有名字，缓冲区释放后自动删除
+        return np.memmap(tempfile.TemporaryFile(dir=_composite_spill_dir), dtype=np.uint8, mode="w+", shape=shape)
+    return np.empty(shape, dtype=np.uint8)
+
+def _composite_white_tiled(image, mask, target_size=None, budget=None, out=None):
+    """按行条带合成白色背景，峰值内存与图像大小无关，由 budget（字节）决定条带高度
+
+    每个条带只把对应区域的遮罩和图像缩放到输出分辨率（resize 的 box 参数，条带之间保持连续），
+    混合后写入 out。out 为 (高, 宽, 3) 的 uint8 数组，可以是预先分配的内存映射文件，
+    为空时自动分配。返回与 out 共享内存的 RGB 图像。
+    """
+    output_width, output_height = output_size = tuple(target_size or image.size)
+    if image.mode not in ("RGB", "L"):
+        # 调色板等模式缩放时只能用最近邻，先转换成 RGB，与整图合成保持一致
+        image = image.convert("RGB")
+    if out is None:
+        out = _composite_output(output_size, budget)
+    strip_rows = output_height
+    if budget is not None:
+        strip_rows = max(1, min(output_height, budget // (output_width * _COMPOSITE_BYTES_PER_PIXEL)))
+
+    image_sy = image.size[1] / output_height
+    mask_sy = mask.size[1] / output_height
+    # 各条带共用同一个定点运算缓冲区
+    work = np.empty((strip_rows, output_width, 3), dtype=np.uint16)
+    for y0 in range(0, output_height, strip_rows):
+        y1 = min(output_height, y0 + strip_rows)
+        strip_size = (output_width, y1 - y0)
+        if image.size == output_size:
+            image_strip = image.crop((0, y0, output_width, y1))
+        else:
+            image_strip = image.resize(strip_size, Image.LANCZOS, box=(0, y0 * image_sy, image.size[0], y1 * image_sy))
+        if image_strip.mode != "RGB":
+            image_strip = image_strip.convert("RGB")
+        mask_strip = mask.resize(strip_size, Image.LANCZOS, box=(0, y0 * mask_sy, mask.size[0], y1 * mask_sy))
+
+        # 直接混合写入输出缓冲区对应的行
+        compositing.over_color(
+            np.asarray(image_strip), np.asarray(mask_strip), _WHITE, out=out[y0:y1], work=work[:y1 - y0]
+        )
+
+    if isinstance(out, np.memmap):
+        out.flush()
+    return Image.frombuffer("RGB", output_size, out, "raw", "RGB", 0, 1)
+
+def _tensor_inputs(images, process_size=(512, 512)):
+    """把图像缩放到模型分辨率，返回 [0, 1] 范围的 (N, 3, 320, 320) float32 数组"""
+    x = np.empty((len(images), 3) + _MODEL_SIZE, dtype=np.float32)
+    for i, image in enumerate(images):
+        img = _resize_uint8(image.convert("RGB").resize(process_size, Image.LANCZOS))
+        np.multiply(np.asarray(img).transpose(2, 0, 1), np.float32(1 / 255), out=x[i])
+    return x
+
+def _refine_tensor(x, passes=4, batch_size=8, tol=None, tier=None):
+    """在模型分辨率上迭代抠图，图像和 alpha 全程保持为模型输入布局的数组
+
+    返回 (N, 1, 320, 320) 的 alpha 和每张图像实际运行的轮数。
+    """
+    alpha = np.ones_like(x[:, :1])
+    passes_used = [0] * x.shape[0]
+    active = np.arange(x.shape[0])
+    for i in range(passes):
+        # 与 _remove 的结果一致：上一轮输出是按 alpha 预乘的 RGBA
+        prev = alpha[active]
+        rgb = x[active] * prev
+        scale = rgb.reshape(len(active), -1).max(axis=1)
+        if i > 0:
+            # ToTensorLab 用包含 alpha 通道在内的最大值归一化
+            scale = np.maximum(scale, prev.reshape(len(active), -1).max(axis=1))
+        inputs = (rgb / scale.reshape(-1, 1, 1, 1) - _MEAN) / _STD
+        new = prev * _forward_batch(inputs, batch_size, tier)[:, np.newaxis]
+        alpha[active] = new
+        for idx in active.tolist():
+            passes_used[idx] += 1
+
+        # 第一轮之后才有可比较的上一轮遮罩
+        if tol is not None and i > 0:
+            delta = np.abs(new - prev).reshape(len(active), -1).mean(axis=1)
+            active = active[delta >= tol]
+            if len(active) == 0:
+                break
+    return alpha, passes_used
+
+def _masks_pil(images, passes=4, batch_size=8, tol=None, tier=None):
     # 将图像调整到合适的大小进行处理
     process_size = (512, 512)
-    img_for_process = image.copy().resize(process_size, Image.LANCZOS)
-    
-    img_out = img_for_process.copy()
-    for _ in range(4):
-        img_out = _remove(img_out)
-    
-    # 创建白色背景，使用原始图像大小
-    white_background = Image.new("RGBA", original_size, (255, 255, 255, 255))
-    
-    # 将抠图结果调整回原始大小
-    img_out = img_out.resize(original_size, Image.LANCZOS)
-    
-    # 创建一个遮罩
-    mask = img_out.split()[3]
-    
-    # 使用原始图像和遮罩创建最终结果
-    final_img = Image.composite(image, white_background, mask)
-    
-    return final_img.convert("RGB")
+    img_outs = [image.copy().resize(process_size, Image.LANCZOS) for image in images]
+    passes_used = [0] * len(images)
+    active = list(range(len(images)))
+
+    for i in range(passes):
+        outs = _remove_batch([img_outs[idx] for idx in active], batch_size, tier)
+        still_active = []
+        for idx, out in zip(active, outs):
+            prev, img_outs[idx] = img_outs[idx], out
+            passes_used[idx] += 1
+            if tol is None or i == 0 or _alpha_delta(prev, out) >= tol:
+                still_active.append(idx)
+        active = still_active
+        if not active:
+            break
+
+    return [img_out.split()[3] for img_out in img_outs], passes_used
+
+def _alpha_delta(prev, out):
+    """两轮结果 alpha 通道的平均绝对差，范围 [0, 1]"""
+    a = np.asarray(prev.getchannel("A"), dtype=np.float32)
+    b = np.asarray(out.getchannel("A"), dtype=np.float32)
+    return float(np.abs(a - b).mean() / 255)
+
+def _masks_tensor(images, passes=4, batch_size=8, tol=None, tier=None):
+    alpha, passes_used = _refine_tensor(_tensor_inputs(images), passes, batch_size, tol, tier)
+    alpha = np.clip(np.round(alpha[:, 0] * 255), 0, 255).astype(np.uint8)
+    return [Image.fromarray(a, mode="L") for a in alpha], passes_used
+
+def _box_mean(x, r):
+    """半径为 r 的均值滤波，用积分图实现，复杂度与半径无关；边界处按窗口内实际像素数取平均"""
+    h, w = x.shape
+    s = np.zeros((h + 1, w + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(x, axis=0, dtype=np.float64), axis=1, out=s[1:, 1:])
+    y0 = np.clip(np.arange(h) - r, 0, h)
+    y1 = np.clip(np.arange(h) + r + 1, 0, h)
+    x0 = np.clip(np.arange(w) - r, 0, w)
+    x1 = np.clip(np.arange(w) + r + 1, 0, w)
+    total = s[y1][:, x1] - s[y0][:, x1] - s[y1][:, x0] + s[y0][:, x0]
+    count = np.outer(y1 - y0, x1 - x0)
+    return (total / count).astype(np.float32)
+
+def guided_filter(guide, src, radius=8, eps=1e-3):
+    """灰度导向滤波 (He et al.)，让 src 的边缘贴合 guide 的边缘；两者都是 [0, 1] 的 float32 二维数组"""
+    mean_i = _box_mean(guide, radius)
+    mean_p = _box_mean(src, radius)
+    cov_ip = _box_mean(guide * src, radius) - mean_i * mean_p
+    var_i = _box_mean(guide * guide, radius) - mean_i * mean_i
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    return _box_mean(a, radius) * guide + _box_mean(b, radius)
+
+# 导向滤波的工作分辨率上限（长边），遮罩最后还会缩放到输出尺寸
+_GUIDED_MAX_SIDE = 1024
+
+def _masks_guided(images, passes=1, batch_size=8, tol=None, tier=None, eps=1e-3):
+    """单轮 U2NET 得到低分辨率遮罩，放大后以原图为导向做导向滤波细化边缘；passes 和 tol 不使用"""
+    predicts = _predict_batch(images, batch_size, tier)
+    masks = []
+    for image, predict in zip(images, predicts):
+        scale = min(1.0, _GUIDED_MAX_SIDE / max(image.size))
+        size = (max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale)))
+        guide_img = image if image.mode in ("RGB", "L") else image.convert("RGB")
+        guide = np.asarray(guide_img.resize(size, Image.BILINEAR).convert("L"), dtype=np.float32) / 255
+        mask = Image.fromarray(predict.astype(np.float32), mode="F").resize(size, Image.BILINEAR)
+        # 滤波半径随工作分辨率变化，约为长边的 1/128
+        refined = guided_filter(guide, np.asarray(mask, dtype=np.float32), max(2, max(size) // 128), eps)
+        masks.append(Image.fromarray(np.clip(np.round(refined * 255), 0, 255).astype(np.uint8), mode="L"))
+    return masks, [1] * len(images)
+
+def remove_bg_mult(image, mode=None, passes=4, tol=None, return_passes=False, tier=None, target_size=None,
+                   source_digest=None):
+    results = remove_bg_mult_batch(
+        [image], batch_size=1, mode=mode, passes=passes, tol=tol, return_passes=return_passes, tier=tier,
+        target_size=target_size, source_digests=[source_digest],
+    )
+    if return_passes:
+        return results[0][0], results[1][0]
+    return results[0]
+
+def remove_bg_mult_batch(images, batch_size=8, mode=None, passes=4, tol=None, return_passes=False, tier=None,
+                         target_size=None, source_digests=None):
+    """批量多次抠图，每一轮把所有图像按 batch_size 分组推理
+
+    mode="pil" 每轮都回到 PIL 图像再缩放；mode="tensor" 在模型分辨率的张量上完成所有轮次，
+    最后只转换一次 PIL 做合成；mode="guided" 只跑一轮，再用导向滤波细化边缘。
+    mode 为空时使用 set_quality_preset 设置的档位。
+    passes 为最多运行的轮数；设置 tol 后，某张图像两轮之间 alpha 的平均变化小于 tol
+    (0~1) 时提前停止。return_passes=True 时额外返回每张图像实际使用的轮数。
+    tier 为模型档位，也可以传入与 images 等长的列表逐张指定。
+    target_size 为输出尺寸 (宽, 高)，给出时直接在输出分辨率上合成，默认为原图大小。
+    source_digests 见 remove_bg_mult_masks。
+    """
+    masks, passes_used = remove_bg_mult_masks(images, batch_size, mode, passes, tol, tier, source_digests)
+    results = [_composite_white(image, mask, target_size) for image, mask in zip(images, masks)]
+    if return_passes:
+        return results, passes_used
+    return results
+
+def remove_bg_mult_masks(images, batch_size=8, mode=None, passes=4, tol=None, tier=None, source_digests=None):
+    """只计算低分辨率 alpha 遮罩 (L 模式)，返回 (遮罩列表, 每张图像的轮数)
+
+    开启遮罩缓存时先按 mask_cache.image_key 查找，只有未命中的图像才送入模型。
+    source_digests 与 images 一一对应，是未经改动的图像所来自的文件内容哈希 (processing.open_image
+    返回的第二项)，给出时按文件内容查找缓存；为空或某一项为 None 时按解码后的像素查找。
+    """
+    mode = mode or QUALITY_PRESETS[_quality_preset]
+    if mode not in MATTING_MODES:
+        raise ValueError(f"未知的抠图模式: {mode}")
+    masks_fn = {"pil": _masks_pil, "tensor": _masks_tensor, "guided": _masks_guided}[mode]
+
+    tiers = tier if isinstance(tier, (list, tuple)) else [tier] * len(images)
+    tiers = [_resolve_tier(t) for t in tiers]
+    masks = [None] * len(images)
+    passes_used = [0] * len(images)
+
+    cache = _mask_cache
+    keys = [None] * len(images)
+    if cache is not None:
+        model_ids = {t: _model_id(t) for t in set(tiers)}
+        digests = source_digests or [None] * len(images)
+        for i, (image, t, digest) in enumerate(zip(images, tiers, digests)):
+            keys[i] = mask_cache.image_key(image, model_ids[t], mode, passes, tol, source_digest=digest)
+            hit = cache.get(keys[i])
+            if hit is not None:
+                masks[i], passes_used[i] = hit
+
+    # 同一档位的图像放在一起推理
+    for t in dict.fromkeys(tiers):
+        indices = [i for i, it in enumerate(tiers) if it == t and masks[i] is None]
+        if not indices:
+            continue
+        group_masks, group_passes = masks_fn([images[i] for i in indices], passes, batch_size, tol, t)
+        for i, mask, used in zip(indices, group_masks, group_passes):
+            masks[i] = mask
+            passes_used[i] = used
+            if cache is not None:
+                cache.put(keys[i], mask, used)
+
+    return masks, passes_used
 
 def change_background(image, background):
     background = background.resize((image.size), resample=Image.BILINEAR)
-    img_out = Image.alpha_composite(background, image)
-    return img_out
+    # 与 Image.alpha_composite 相同的定点运算，直接写回缩放后的背景缓冲区
+    out = np.array(background.convert("RGBA") if background.mode != "RGBA" else background)
+    src = np.asarray(image.convert("RGBA") if image.mode != "RGBA" else image)
+    compositing.alpha_composite(out, src, out=out)
+    return Image.fromarray(out, "RGBA")
 
-def is_model_loaded():
+def is_model_loaded(tier=None):
     """检查模型是否已加载"""
-    return _model_pred is not None
+    return _resolve_tier(tier) in _models
+
+def warmup(passes=2, batch_size=1, tier=None):
+    """用随机输入跑几次前向，让首次真正的推理不用承担初始化和 JIT 优化的开销"""
+    model_pred = load_model(tier)
+    inputs = np.random.rand(batch_size, 3, 320, 320).astype(np.float32)
+    for _ in range(passes):
+        _run_model(model_pred, inputs)
 
-def preload_model_async():
-    """异步预加载模型"""
+def preload_model_async(warmup_passes=2, tier=None):
+    """异步预加载模型并预热"""
     def _load():
-        load_model()
+        load_model(tier)
+        if warmup_passes:
+            warmup(warmup_passes, tier=tier)
     
     thread = threading.Thread(target=_load, daemon=True)
     thread.start()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+U2NET ONNX 导出脚本
+把 U2NET / U2NETP 导出为只输出融合遮罩 d0 的 ONNX 模型，供 engine 的 onnx 后端使用。
+
+用法: python export_onnx.py [--tier full|lite] [--weights 权重路径] [--output 输出路径]
+      python export_onnx.py --check   # 用随机权重对比 torch 与 ONNX Runtime 的遮罩
+导出后调用 engine.set_backend("onnx") 即可在不导入 torch 的情况下推理。
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+import engine_lazy as engine
+from u2net import model
+
+
+def build_net(tier="full", weights=None):
+    """构建导出用的推理模型；不给权重时使用随机初始化"""
+    net = getattr(model, engine.MODEL_TIERS[tier][1])(3, 1)
+    if weights is not None:
+        net.load_state_dict(torch.load(weights, map_location="cpu"))
+    net.eval()
+    net.inference_only = True
+    return engine.optimize_for_inference(net)
+
+
+def export(net, output_path, opset=11):
+    """导出 ONNX，batch 维度为动态"""
+    dirname = os.path.dirname(output_path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            net,
+            torch.rand(1, 3, 320, 320),
+            output_path,
+            opset_version=opset,
+            input_names=["input"],
+            output_names=["d0"],
+            dynamic_axes={"input": {0: "batch"}, "d0": {0: "batch"}},
+        )
+    print(f"ONNX 模型已保存: {output_path}")
+
+
+def compare_backends(tier="full", batch=2, atol=1e-3, seed=0):
+    """随机权重下对比 torch 与 ONNX Runtime 输出的遮罩 (sigmoid d0)，返回 (是否一致, 最大绝对误差)"""
+    import onnxruntime as ort
+
+    torch.manual_seed(seed)
+    net = build_net(tier)
+    inputs = np.random.RandomState(seed).randn(batch, 3, 320, 320).astype(np.float32)
+
+    with torch.no_grad():
+        expected = net(torch.from_numpy(inputs))[:, 0].numpy()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        onnx_path = os.path.join(tmp_dir, f"{tier}.onnx")
+        export(net, onnx_path)
+        session = ort.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+        actual = session.run(None, {"input": inputs})[0][:, 0]
+
+    # 随机权重的输出动态范围很小，直接比较 sigmoid 结果，避免归一化放大误差
+    max_diff = float(np.abs(expected - actual).max())
+    print(f"{tier}: torch 与 ONNX Runtime 遮罩最大误差 {max_diff:.6f}")
+    return max_diff <= atol, max_diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导出 U2NET ONNX 模型")
+    parser.add_argument("--tier", choices=sorted(engine.MODEL_TIERS), default="full", help="模型档位")
+    parser.add_argument("--weights", help="PyTorch 权重路径，默认使用 ckpt 目录中对应档位的权重")
+    parser.add_argument("--output", help="ONNX 模型保存路径，默认保存到 ckpt 目录")
+    parser.add_argument("--opset", type=int, default=11, help="ONNX opset 版本")
+    parser.add_argument("--check", action="store_true", help="只用随机权重做后端一致性检查")
+    args = parser.parse_args()
+
+    if args.check:
+        ok = all([compare_backends(tier)[0] for tier in sorted(engine.MODEL_TIERS)])
+        print("一致性检查通过" if ok else "一致性检查失败")
+        return 0 if ok else 1
+
+    weights = args.weights or engine.get_model_path(tier=args.tier)
+    export(build_net(args.tier, weights), args.output or engine.get_onnx_model_path(args.tier), args.opset)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
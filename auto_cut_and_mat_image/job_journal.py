@@ -0,0 +1,146 @@
+"""
+批处理任务日志
+用 SQLite 记录每张图片的路径、输入哈希、修改时间/大小、处理参数、输出路径、状态和抠图轮数。
+批处理中断或重复运行时，已经完成且之后没有被改动的图片会被跳过；
+判断只需要一次 stat 和一次主键查询，与目录中的图片数量无关。
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+JOURNAL_NAME = ".batchcut_journal.sqlite"
+
+
+def default_journal_path(folder_path):
+    """默认把日志放在批处理目录下"""
+    return os.path.join(folder_path, JOURNAL_NAME)
+
+
+def file_stat(path):
+    """返回 (修改时间纳秒, 大小)，文件不存在时返回 None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """文件内容的哈希"""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class JobJournal:
+    """一个批处理目录的任务日志，可以在多个线程中共用"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                path TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                params TEXT NOT NULL,
+                input_hash TEXT,
+                input_mtime_ns INTEGER,
+                input_size INTEGER,
+                output TEXT,
+                output_mtime_ns INTEGER,
+                output_size INTEGER,
+                status TEXT NOT NULL,
+                error TEXT,
+                passes INTEGER,
+                updated REAL NOT NULL,
+                PRIMARY KEY (path, kind)
+            )"""
+        )
+        # 旧版本的日志没有 passes 列
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "passes" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN passes INTEGER")
+        self._conn.commit()
+
+    @staticmethod
+    def encode_params(params):
+        return json.dumps(params, sort_keys=True)
+
+    def is_done(self, path, kind, params):
+        """图片是否已经按相同参数处理完成，并且之后没有被改动"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT params, input_mtime_ns, input_size, output, output_mtime_ns, output_size, status "
+                "FROM jobs WHERE path = ? AND kind = ?",
+                (path, kind),
+            ).fetchone()
+        if row is None or row[0] != self.encode_params(params):
+            return False
+        _, in_mtime, in_size, output, out_mtime, out_size, status = row
+        current = file_stat(path)
+
+        if status == "running":
+            # 上次在写出后、记录完成前中断：输出是原子替换的，覆盖原图时文件已变化就说明写出已经完成
+            return output == path and current is not None and current != (in_mtime, in_size)
+        if status != "ok":
+            return False
+        if output == path:
+            # 覆盖原图：当前文件就是上次写出的结果
+            return current == (out_mtime, out_size)
+        # 写到其他位置：输入没变，输出也还在
+        return current == (in_mtime, in_size) and file_stat(output) == (out_mtime, out_size)
+
+    def pending(self, paths, kind, params):
+        """过滤掉已经完成的图片，返回仍需处理的路径列表"""
+        return [path for path in paths if not self.is_done(path, kind, params)]
+
+    def begin(self, path, kind, params, input_stat, input_hash=None, output=None):
+        """写出结果之前记录为 running，中断后可以判断写出是否已经完成"""
+        self._write(path, kind, params, "running", input_stat, input_hash, output or path, None, None, None)
+
+    def record(self, path, kind, params, status, input_stat=None, input_hash=None, output=None, error=None,
+               passes=None):
+        """记录一张图片的处理结果，status 为 "ok" 或 "failed"；passes 为抠图实际使用的轮数"""
+        output = output or path
+        output_stat = file_stat(output) if status == "ok" else None
+        self._write(path, kind, params, status, input_stat, input_hash, output, output_stat, error, passes)
+
+    def _write(self, path, kind, params, status, input_stat, input_hash, output, output_stat, error, passes):
+        in_mtime, in_size = input_stat or (None, None)
+        out_mtime, out_size = output_stat or (None, None)
+        with self._lock:
+            # input_hash 为空时保留之前记录的哈希
+            self._conn.execute(
+                "INSERT INTO jobs (path, kind, params, input_hash, input_mtime_ns, input_size, output, "
+                "output_mtime_ns, output_size, status, error, passes, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path, kind) DO UPDATE SET params = excluded.params, "
+                "input_hash = COALESCE(excluded.input_hash, jobs.input_hash), "
+                "input_mtime_ns = COALESCE(excluded.input_mtime_ns, jobs.input_mtime_ns), "
+                "input_size = COALESCE(excluded.input_size, jobs.input_size), "
+                "output = excluded.output, output_mtime_ns = excluded.output_mtime_ns, "
+                "output_size = excluded.output_size, status = excluded.status, "
+                "error = excluded.error, passes = excluded.passes, updated = excluded.updated",
+                (path, kind, self.encode_params(params), input_hash, in_mtime, in_size, output,
+                 out_mtime, out_size, status, error, passes, time.time()),
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
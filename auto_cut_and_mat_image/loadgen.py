@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+抠图服务压测脚本
+用多个并发客户端向 server.py 发送图片，统计延迟 p50 / p99 和每秒处理的图片数量。
+
+用法: python loadgen.py 图片目录或文件 [--url http://127.0.0.1:8765/matte] [--concurrency 8] [--requests 200]
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def load_payloads(input_path, limit=None):
+    """读取要发送的图片字节"""
+    if os.path.isdir(input_path):
+        # 不导入 processing，压测端不需要安装 OpenCV / torch
+        files = sorted(
+            os.path.join(root, file)
+            for root, dirs, names in os.walk(input_path)
+            for file in names
+            if file.lower().endswith(IMAGE_EXTENSIONS)
+        )
+    else:
+        files = [input_path]
+    files = files[:limit] if limit else files
+    payloads = []
+    for path in files:
+        with open(path, "rb") as f:
+            payloads.append(f.read())
+    return payloads
+
+
+def send(url, payload, timeout=120):
+    """发送一次请求，返回 (延迟秒数, 是否成功)"""
+    request = urllib.request.Request(url, data=payload, headers={"Content-Type": "application/octet-stream"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            ok = response.status == 200
+    except Exception as e:
+        print(f"请求失败: {e}")
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def run_load(url, payloads, concurrency=8, total_requests=200):
+    """并发发送 total_requests 个请求，返回统计结果"""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    counter = iter(range(total_requests))
+
+    def client():
+        nonlocal errors
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            latency, ok = send(url, payloads[i % len(payloads)])
+            with lock:
+                if ok:
+                    latencies.append(latency)
+                else:
+                    errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(client)
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "requests": total_requests,
+        "errors": errors,
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "images_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+        "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+        "mean_ms": float(latencies.mean()) if len(latencies) else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="抠图服务压测")
+    parser.add_argument("input", help="图片目录或单个图片文件")
+    parser.add_argument("--url", default="http://127.0.0.1:8765/matte?format=png", help="服务地址")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发客户端数量")
+    parser.add_argument("--requests", type=int, default=200, help="总请求数")
+    parser.add_argument("--num", type=int, help="最多使用的图片数量")
+    args = parser.parse_args()
+
+    payloads = load_payloads(args.input, args.num)
+    if not payloads:
+        print(f"错误：没有找到图片 {args.input}")
+        return 1
+
+    report = run_load(args.url, payloads, args.concurrency, args.requests)
+    print(f"并发 {report['concurrency']}，请求 {report['requests']} 个，失败 {report['errors']} 个，"
+          f"耗时 {report['seconds']:.1f} 秒")
+    if report["p50_ms"] is not None:
+        print(f"吞吐量 {report['images_per_sec']:.2f} 张/秒，延迟 p50={report['p50_ms']:.0f}ms "
+              f"p99={report['p99_ms']:.0f}ms 平均={report['mean_ms']:.0f}ms")
+    return 0 if report["errors"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,25 +1,34 @@
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
-from PIL import Image, ImageTk
-import cv2
-import numpy as np
+from PIL import Image
 import os
 import shutil
 from string import ascii_uppercase
 import sys
+
+# 安装后的 batchcut 命令以 auto_cut_and_mat_image.main 导入本模块，这时同目录的模块不在 sys.path 上
+_module_dir = os.path.dirname(os.path.abspath(__file__))
+if _module_dir not in sys.path:
+    sys.path.insert(0, _module_dir)
+
 import engine_lazy as engine
-import splash_screen
+import processing
+import matting_pool
+import pipeline
+import job_journal
+import cli
 import threading
+import multiprocessing
 
-def resource_path(relative_path):
-    """ 获取资源的绝对路径 """
-    try:
-        # PyInstaller 创建临时文件夹 _MEIPASS
-        base_path = sys._MEIPASS
-    except Exception:
-        base_path = os.path.dirname(__file__)
+# 界面用到的模块在 _import_gui 中导入，命令行模式和多进程的工作进程都不需要 tkinter
+tk = ttk = filedialog = messagebox = ImageTk = splash_screen = None
 
-    return os.path.join(base_path, relative_path)
+
+def _import_gui():
+    """导入 tkinter 等界面模块；没有 Tk 的服务器上只运行命令行时不会调用"""
+    global tk, ttk, filedialog, messagebox, ImageTk, splash_screen
+    import tkinter as tk
+    from tkinter import ttk, filedialog, messagebox
+    from PIL import ImageTk
+    import splash_screen
 
 class App:
     def __init__(self, root):
@@ -40,12 +49,13 @@ class App:
         self.create_tab2()
         
         # 加载人脸检测模型
-        prototxt_path = resource_path('Face Detector Prototxt.prototxt')
-        caffemodel_path = resource_path('Face Detection Model.caffemodel')
-        self.net = cv2.dnn.readNetFromCaffe(prototxt_path, caffemodel_path)
+        self.net = processing.load_face_net()
 
         # 加载 U2NET 模型
         # engine.load_model()
+
+        # 开启遮罩缓存，重新处理没有改动的图片时跳过推理
+        engine.set_mask_cache()
     
     def create_tab1(self):
         self.size_label = ttk.Label(self.tab1, text="目标尺寸 (宽 x 高)：")
@@ -76,6 +86,13 @@ class App:
         self.percentage_entry.insert(0, "70")
         self.percentage_entry.pack(pady=10)
         
+        self.workers_label = ttk.Label(self.tab1, text="线程数：")
+        self.workers_label.pack(pady=10)
+        
+        self.workers_entry = ttk.Entry(self.tab1)
+        self.workers_entry.insert(0, str(os.cpu_count() or 1))
+        self.workers_entry.pack(pady=10)
+        
         self.batch_button = ttk.Button(self.tab1, text="批量处理", command=self.batch_process)
         self.batch_button.pack(pady=10)
         
@@ -111,6 +128,34 @@ class App:
         self.dpi_entry3.insert(0, "300,300")
         self.dpi_entry3.pack(pady=10)
         
+        self.batch_size_label3 = ttk.Label(self.tab2, text="批大小：")
+        self.batch_size_label3.pack(pady=10)
+        
+        self.batch_size_entry3 = ttk.Entry(self.tab2)
+        self.batch_size_entry3.insert(0, "8")
+        self.batch_size_entry3.pack(pady=10)
+        
+        self.tier_label3 = ttk.Label(self.tab2, text="模型 (full 精细 / lite 快速)：")
+        self.tier_label3.pack(pady=10)
+        
+        self.tier_combo3 = ttk.Combobox(self.tab2, values=list(engine.MODEL_TIERS), state="readonly")
+        self.tier_combo3.set(engine.get_model_tier())
+        self.tier_combo3.pack(pady=10)
+        
+        self.preset_label3 = ttk.Label(self.tab2, text="质量 (quality 4 轮 / fast 单轮 + 边缘细化)：")
+        self.preset_label3.pack(pady=10)
+        
+        self.preset_combo3 = ttk.Combobox(self.tab2, values=list(engine.QUALITY_PRESETS), state="readonly")
+        self.preset_combo3.set(engine.get_quality_preset())
+        self.preset_combo3.pack(pady=10)
+        
+        self.workers_label3 = ttk.Label(self.tab2, text="进程数 (1 为单进程)：")
+        self.workers_label3.pack(pady=10)
+        
+        self.workers_entry3 = ttk.Entry(self.tab2)
+        self.workers_entry3.insert(0, "1")
+        self.workers_entry3.pack(pady=10)
+        
         self.batch_button3 = ttk.Button(self.tab2, text="批量处理", command=self.batch_process_matting)
         self.batch_button3.pack(pady=10)
         
@@ -142,13 +187,15 @@ class App:
         dpi = tuple(map(int, self.dpi_entry.get().split(',')))
         confidence = float(self.confidence_entry.get())
         cut_percentage = float(self.percentage_entry.get()) / 100
+        workers = max(1, int(self.workers_entry.get()))
         
-        # 获取所有子文件夹中的图片文件
-        image_files = []
-        for root, dirs, files in os.walk(folder_path):
-            for file in files:
-                if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    image_files.append(os.path.join(root, file))
+        # 获取所有子文件夹中的图片文件，跳过任务日志中已经完成的图片
+        all_files = processing.list_image_files(folder_path)
+        params = {"size": [target_width, target_height], "dpi": list(dpi),
+                  "confidence": confidence, "cut_percentage": cut_percentage}
+        journal = job_journal.JobJournal(job_journal.default_journal_path(folder_path))
+        image_files = journal.pending(all_files, "crop", params)
+        input_stats = {image_path: job_journal.file_stat(image_path) for image_path in image_files}
         
         total_files = len(image_files)
         
@@ -166,15 +213,52 @@ class App:
         progress_bar["maximum"] = total_files
         progress_bar["value"] = 0
         
-        for i, image_path in enumerate(image_files, 1):
-            self.process_image(image_path, target_width, target_height, dpi, confidence, cut_percentage)
-            
-            progress_bar["value"] = i
-            progress_label.config(text=f"处理进度: {i}/{total_files}")
-            progress_window.update()
-        
+        # 解码、人脸检测、裁剪保存分阶段并行，已解码的图片按组一起检测；
+        # 多个检测线程各自持有一个检测网络，进度仍然在界面线程中更新。
+        # JPEG 先按检测需要的分辨率缩小解码，截头时只在需要时才解码更高的分辨率
+        def detect(sources):
+            return list(zip(sources, processing.detect_sources(processing.thread_face_net(), sources, confidence)))
+        
+        def finish(image_path, detected):
+            src, face_box = detected
+            final_img = processing.crop_source(src, face_box, target_width, target_height, cut_percentage)
+            # 覆盖前记录输入哈希，中断后可以判断这张图片是否已经写出
+            journal.begin(image_path, "crop", params, input_stats[image_path], job_journal.file_digest(image_path))
+            # 直接覆盖原始图像
+            processing.save_jpeg(final_img, image_path, dpi, quality=100)
+        
+        failed = []
+        batch_size = processing.DETECT_BATCH_SIZE
+        # 批处理结束后恢复 OpenCV 原来的线程数
+        with processing.crop_threads(workers):
+            results = pipeline.run_pipeline(
+                image_files, processing.read_for_detection, detect, finish,
+                decode_workers=workers, infer_workers=workers, encode_workers=workers,
+                decode_depth=2 * batch_size, infer_depth=2 * batch_size, batch_size=batch_size
+            )
+            for i, (image_path, _, error) in enumerate(results, 1):
+                if error is not None:
+                    print(f"错误：处理 {image_path} 失败: {error}")
+                    failed.append(image_path)
+                    journal.record(image_path, "crop", params, "failed", input_stats[image_path], error=str(error))
+                else:
+                    journal.record(image_path, "crop", params, "ok")
+                
+                progress_bar["value"] = i
+                progress_label.config(text=f"处理进度: {i}/{total_files}")
+                progress_window.update()
+        
+        journal.close()
         progress_window.destroy()  # 关闭进度条弹窗
-        messagebox.showinfo("成功", "批量处理完成")
+        self.show_batch_summary(total_files - len(failed), len(all_files) - total_files, len(failed))
+    
+    def show_batch_summary(self, processed, skipped, failed):
+        summary = f"批量处理完成\n处理: {processed} 张\n跳过: {skipped} 张\n失败: {failed} 张"
+        print(summary.replace("\n", "，"))
+        if failed:
+            messagebox.showwarning("完成", summary)
+        else:
+            messagebox.showinfo("成功", summary)
     
     def single_process(self):
         file_path = filedialog.askopenfilename(filetypes=[("Image files", "*.jpg *.jpeg *.png")])
@@ -195,57 +279,11 @@ class App:
         self.processed_image = processed_image
 
     def process_image(self, image_path, target_width, target_height, dpi, confidence, cut_percentage, display=False):
-        img = cv2.imread(image_path)
-        if img is None:
+        try:
+            final_img = processing.crop_path(self.net, image_path, target_width, target_height, confidence, cut_percentage)
+        except IOError:
             print(f"错误：无法读取图像 {image_path}")
             return None
-
-        (h, w) = img.shape[:2]
-        blob = cv2.dnn.blobFromImage(cv2.resize(img, (300, 300)), 1.0, (300, 300), (104.0, 177.0, 123.0))
-        self.net.setInput(blob)
-        detections = self.net.forward()
-
-        face_detected = False
-        cropped_img = img  # 默认使用整个图像
-        
-        for i in range(0, detections.shape[2]):
-            conf = detections[0, 0, i, 2]
-            if conf > confidence:
-                face_detected = True
-                box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-                (startX, startY, endX, endY) = box.astype("int")
-                chin_y = startY + int(cut_percentage * (endY - startY))
-                # 从下巴位置开始截取到图像底部
-                cropped_img = img[chin_y:, :]
-                break
-
-        if not face_detected:
-            print(f"警告：在图像 {image_path} 中未检测到人脸，使用原图")
-
-        # 转换为 PIL 图像进行处理
-        pil_image = Image.fromarray(cv2.cvtColor(cropped_img, cv2.COLOR_BGR2RGB))
-        
-        # 计算缩放比例，使用较大的比例以填满目标尺寸
-        original_width, original_height = pil_image.size
-        scale_w = target_width / original_width
-        scale_h = target_height / original_height
-        scale = max(scale_w, scale_h)  # 使用较大的缩放比例填满目标区域
-        
-        # 计算缩放后的尺寸
-        new_width = int(original_width * scale)
-        new_height = int(original_height * scale)
-        
-        # 缩放图像
-        resized_img = pil_image.resize((new_width, new_height), Image.LANCZOS)
-        
-        # 计算裁剪位置（居中裁剪）
-        left = (new_width - target_width) // 2
-        top = (new_height - target_height) // 2
-        right = left + target_width
-        bottom = top + target_height
-        
-        # 裁剪到目标尺寸
-        final_img = resized_img.crop((left, top, right, bottom))
         
         if display:
             return final_img
@@ -277,8 +315,10 @@ class App:
         size = self.size_entry3.get().split('x')
         target_width, target_height = int(size[0]), int(size[1])
         dpi = tuple(map(int, self.dpi_entry3.get().split(',')))
+        tier = self.tier_combo3.get()
+        engine.set_quality_preset(self.preset_combo3.get())
         
-        processed_image = self.process_image_matting(file_path, target_width, target_height, dpi, display=True)
+        processed_image = self.process_image_matting(file_path, target_width, target_height, dpi, display=True, tier=tier)
         
         if processed_image:
             self.display_image_matting(processed_image)  # 使用适合抠图标签页的展示函数
@@ -295,12 +335,17 @@ class App:
         size = self.size_entry3.get().split('x')
         target_width, target_height = int(size[0]), int(size[1])
         dpi = tuple(map(int, self.dpi_entry3.get().split(',')))
-        
-        image_files = []
-        for root, dirs, files in os.walk(folder_path):
-            for file in files:
-                if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    image_files.append(os.path.join(root, file))
+        batch_size = max(1, int(self.batch_size_entry3.get()))
+        tier = self.tier_combo3.get()
+        workers = max(1, int(self.workers_entry3.get()))
+        
+        all_files = processing.list_image_files(folder_path)
+        preset = self.preset_combo3.get()
+        engine.set_quality_preset(preset)
+        params = {"size": [target_width, target_height], "dpi": list(dpi), "tier": tier, "preset": preset}
+        journal = job_journal.JobJournal(job_journal.default_journal_path(folder_path))
+        image_files = journal.pending(all_files, "matte", params)
+        input_stats = {image_path: job_journal.file_stat(image_path) for image_path in image_files}
         
         total_files = len(image_files)
         
@@ -317,34 +362,90 @@ class App:
         progress_bar["maximum"] = total_files
         progress_bar["value"] = 0
         
-        for i, image_path in enumerate(image_files, 1):
-            self.process_image_matting(image_path, target_width, target_height, dpi)
+        if workers > 1:
+            # 多进程处理，结果按完成顺序返回
+            failed = []
+            # 工作进程覆盖原图之前在任务日志中记录 running
+            results = matting_pool.run_matting_pool(
+                image_files, target_width, target_height, dpi, workers=workers, tier=tier,
+                journal=(journal.path, "matte", params)
+            )
+            for i, result in enumerate(results, 1):
+                if result["status"] != "ok":
+                    print(f"错误：处理 {result['path']} 失败: {result['error']}")
+                    failed.append(result["path"])
+                journal.record(result["path"], "matte", params, result["status"], input_stats[result["path"]],
+                               result["input_hash"], error=result["error"], passes=result["passes"])
+                
+                progress_bar["value"] = i
+                progress_label.config(text=f"处理进度: {i}/{total_files}")
+                progress_window.update()
+            
+            journal.close()
+            progress_window.destroy()
+            self.show_batch_summary(total_files - len(failed), len(all_files) - total_files, len(failed))
+            return
+        
+        # 解码、抠图、缩放保存分阶段并行，已解码的图片按批送入模型推理；
+        # 输出比原图小时，JPEG 按目标尺寸缩小解码
+        def decode(image_path):
+            return processing.open_image(image_path, (target_width, target_height))
+        
+        def matte(decoded):
+            images, digests = zip(*decoded)
+            return engine.remove_bg_mult_batch(
+                list(images), batch_size=batch_size, tier=tier, target_size=(target_width, target_height),
+                source_digests=list(digests)
+            )
+        
+        def finish(image_path, processed_img):
+            journal.begin(image_path, "matte", params, input_stats[image_path], job_journal.file_digest(image_path))
+            self.save_matting_result(image_path, processed_img, target_width, target_height, dpi)
+        
+        failed = []
+        results = pipeline.run_pipeline(
+            image_files, decode, matte, finish,
+            decode_depth=2 * batch_size, batch_size=batch_size
+        )
+        for i, (image_path, _, error) in enumerate(results, 1):
+            if error is not None:
+                print(f"错误：处理 {image_path} 失败: {error}")
+                failed.append(image_path)
+                journal.record(image_path, "matte", params, "failed", input_stats[image_path], error=str(error))
+            else:
+                journal.record(image_path, "matte", params, "ok")
             
             progress_bar["value"] = i
             progress_label.config(text=f"处理进度: {i}/{total_files}")
             progress_window.update()
         
+        journal.close()
         progress_window.destroy()
-        messagebox.showinfo("成功", "批量处理完成")
+        self.show_batch_summary(total_files - len(failed), len(all_files) - total_files, len(failed))
 
-    def process_image_matting(self, image_path, target_width, target_height, dpi, display=False):
-        img = Image.open(image_path)
+    def process_image_matting(self, image_path, target_width, target_height, dpi, display=False, tier=None):
+        # 输出比原图小时，JPEG 按目标尺寸缩小解码
+        img, digest = processing.open_image(image_path, (target_width, target_height))
         if img is None:
             print(f"错误：无法读取图像 {image_path}")
             return None
 
-        # 使用 remove_bg_mult 进行抠图
-        processed_img = engine.remove_bg_mult(img)
+        # 使用 remove_bg_mult 进行抠图，直接在目标尺寸上合成
+        processed_img = engine.remove_bg_mult(
+            img, tier=tier, target_size=(target_width, target_height), source_digest=digest
+        )
+
+        return self.save_matting_result(image_path, processed_img, target_width, target_height, dpi, display)
 
+    def save_matting_result(self, image_path, processed_img, target_width, target_height, dpi, display=False):
         # 调整图像大小
-        resized_img = processed_img.resize((target_width, target_height), Image.LANCZOS)
+        resized_img = processing.resize_matting_result(processed_img, target_width, target_height)
         
         if display:
             return resized_img
         else:
             # 始终覆盖原始图像
-            output_path = image_path
-            resized_img.save(output_path, 'JPEG', dpi=dpi, quality=95)
+            processing.save_jpeg(resized_img, image_path, dpi)
         return None
 
     def download_image_matting(self):
@@ -397,7 +498,12 @@ class App:
 
 
 def main():
-    """主函数，简化启动流程"""
+    """主函数，简化启动流程；带命令行参数时不启动界面，交给 cli 处理"""
+    if len(sys.argv) > 1:
+        sys.exit(cli.main(sys.argv[1:]))
+    
+    _import_gui()
+    
     # 创建主窗口
     root = tk.Tk()
     root.title("BatchCut - 正在启动...")
@@ -450,4 +556,6 @@ def main():
         root.destroy()
 
 if __name__ == "__main__":
+    # 打包后的程序启动多进程工作池时需要
+    multiprocessing.freeze_support()
     main()
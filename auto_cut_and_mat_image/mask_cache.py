@@ -0,0 +1,124 @@
+"""
+抠图遮罩磁盘缓存
+以 图片文件内容的哈希（调用方没有给出时用解码后像素的哈希） + 模型标识 + 抠图参数 作为键，
+把低分辨率 alpha 遮罩保存为灰度 PNG。
+命中时跳过全部推理；总大小超过上限时按最近使用时间 (文件 mtime) 淘汰最旧的遮罩。
+"""
+
+import hashlib
+import os
+import threading
+
+from PIL import Image, PngImagePlugin
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def default_cache_dir():
+    """默认缓存目录: ~/.cache/auto_cut_and_mat_image/masks"""
+    return os.path.join(os.path.expanduser("~"), ".cache", "auto_cut_and_mat_image", "masks")
+
+
+def image_key(image, *settings, source_digest=None):
+    """计算缓存键
+
+    source_digest 为图片文件内容的哈希，只能在 image 是这个文件未经改动的解码结果时给出：
+    JPEG 按目标尺寸缩小解码 (draft) 时，同一个文件的解码像素随目标尺寸变化，
+    按文件内容计算的键换个输出尺寸重新导出仍然命中。
+    没有给出时按解码后的像素计算，同一张图片换个文件名或重新保存元数据不影响命中。
+    """
+    h = hashlib.blake2b(digest_size=20)
+    if source_digest is not None:
+        h.update(f"file:{source_digest}:{image.mode}:{settings!r}".encode("utf-8"))
+        return h.hexdigest()
+    h.update(f"{image.mode}:{image.size}:{settings!r}".encode("utf-8"))
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+class MaskCache:
+    """按键存取 L 模式遮罩的目录缓存，可以在多个线程中共用"""
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        # 前两位做子目录，避免单个目录里文件过多
+        return os.path.join(self.cache_dir, key[:2], key + ".png")
+
+    def get(self, key):
+        """返回 (遮罩, 抠图轮数)，未命中时返回 None"""
+        path = self._path(key)
+        try:
+            with Image.open(path) as img:
+                img.load()
+                mask = img.convert("L") if img.mode != "L" else img.copy()
+                passes = int(img.info.get("passes", 0))
+            # 更新 mtime，作为最近使用时间
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return mask, passes
+
+    def put(self, key, mask, passes=0):
+        """写入遮罩，先写临时文件再替换，写入后检查总大小"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        info = PngImagePlugin.PngInfo()
+        info.add_text("passes", str(passes))
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        mask.save(tmp_path, "PNG", pnginfo=info)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(s for _, s, _ in self._entries())
+            else:
+                self._total_bytes += size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, dirs, files in os.walk(self.cache_dir):
+            for file in files:
+                if file.endswith(".png"):
+                    path = os.path.join(root, file)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, st.st_size, st.st_mtime
+
+    def _evict(self):
+        # 淘汰到上限的 90%，避免每次写入都重新扫描目录
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._total_bytes = total
+
+    def size_bytes(self):
+        """缓存当前占用的字节数"""
+        return sum(size for _, size, _ in self._entries())
+
+    def clear(self):
+        """删除所有缓存的遮罩"""
+        with self._lock:
+            for path, _, _ in list(self._entries()):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._total_bytes = 0
@@ -0,0 +1,125 @@
+"""
+多进程抠图工作池
+模型只在主进程加载一次，权重移到共享内存后交给各工作进程，不会在每个进程里重复加载；
+每个进程按 threads_per_worker 限制推理线程数，结果按完成顺序逐个返回。
+"""
+
+import multiprocessing
+import os
+import time
+
+import engine_lazy as engine
+import job_journal
+import processing
+
+# 覆盖原图时每个工作进程各自打开的任务日志: (JobJournal, 任务类型, 处理参数)
+_journal = None
+
+
+def default_threads_per_worker(workers):
+    """把 CPU 核数平均分给各个工作进程"""
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def _share_model(tier):
+    """在主进程加载模型并把权重放进共享内存；只有 torch 后端的 fp32 模型可以共享"""
+    if engine.get_backend() != "torch" or engine.get_precision() != "fp32":
+        return None
+    net = engine.load_model(tier)
+    net.share_memory()
+    return net
+
+
+def _get_context(start_method, shared_model):
+    if shared_model is not None:
+        # torch.multiprocessing 注册了张量的序列化方式，传递时只发送共享内存句柄
+        import torch.multiprocessing
+        return torch.multiprocessing.get_context(start_method)
+    return multiprocessing.get_context(start_method)
+
+
+def _init_worker(threads, settings, shared_model):
+    global _journal
+    engine.set_backend(settings["backend"])
+    engine.set_precision(settings["precision"])
+    engine.set_execution_mode(settings["exec_mode"])
+    engine.set_model_tier(settings["tier"])
+    engine.set_quality_preset(settings["quality_preset"])
+    engine.set_composite_budget(settings["composite_budget"], settings["composite_spill_dir"])
+    engine.set_num_threads(threads)
+    if settings["mask_cache"] is not None:
+        engine.set_mask_cache(True, *settings["mask_cache"])
+    if shared_model is not None:
+        engine.register_model(shared_model, settings["tier"])
+    if settings["journal"] is not None:
+        journal_path, kind, params = settings["journal"]
+        _journal = (job_journal.JobJournal(journal_path), kind, params)
+
+
+def _matte_task(task):
+    image_path, output_path, target_width, target_height, dpi, tol = task
+    start = time.perf_counter()
+    input_hash = None
+    passes_used = None
+    try:
+        input_hash = job_journal.file_digest(image_path)
+        if _journal is not None:
+            # 写出之前记录为 running，写出后、父进程记录完成前中断时，重新运行不会再次处理已覆盖的图片
+            journal, kind, params = _journal
+            journal.begin(image_path, kind, params, job_journal.file_stat(image_path), input_hash, output_path)
+        passes_used = processing.matte_file(image_path, target_width, target_height, dpi, output_path, tol=tol)
+        status, error = "ok", None
+    except Exception as e:
+        status, error = "failed", f"{type(e).__name__}: {e}"
+    return {
+        "path": image_path,
+        "output": output_path or image_path,
+        "status": status,
+        "error": error,
+        "input_hash": input_hash,
+        "passes": passes_used,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def run_matting_pool(image_files, target_width, target_height, dpi, workers=None,
+                     threads_per_worker=None, output_paths=None, tier=None, start_method="spawn", journal=None,
+                     tol=None):
+    """用多进程批量抠图，按完成顺序逐个产出每张图片的处理结果
+
+    output_paths 与 image_files 一一对应，为空时覆盖原图。每个结果是包含
+    path / output / status ("ok" 或 "failed") / error / seconds / input_hash / passes 的字典。
+    tol 为抠图的收敛阈值，见 engine_lazy.remove_bg_mult_batch。
+    journal 为 (任务日志路径, 任务类型, 处理参数) 时，工作进程在写出每张图片之前把它记录为 running，
+    完成状态仍由调用方记录。
+    """
+    workers = workers or os.cpu_count() or 1
+    threads = threads_per_worker or default_threads_per_worker(workers)
+    settings = {
+        "backend": engine.get_backend(),
+        "precision": engine.get_precision(),
+        "exec_mode": engine.get_execution_mode(),
+        "tier": tier or engine.get_model_tier(),
+        "quality_preset": engine.get_quality_preset(),
+        "composite_budget": engine.get_composite_budget(),
+        "composite_spill_dir": engine.get_composite_spill_dir(),
+        "mask_cache": None,
+        "journal": journal,
+    }
+    cache = engine.get_mask_cache()
+    if cache is not None:
+        # 各进程共用同一个缓存目录
+        settings["mask_cache"] = (cache.cache_dir, cache.max_bytes)
+    shared_model = _share_model(settings["tier"])
+    ctx = _get_context(start_method, shared_model)
+
+    if output_paths is None:
+        output_paths = [None] * len(image_files)
+    tasks = [
+        (image_path, output_path, target_width, target_height, dpi, tol)
+        for image_path, output_path in zip(image_files, output_paths)
+    ]
+
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(threads, settings, shared_model)) as pool:
+        for result in pool.imap_unordered(_matte_task, tasks, chunksize=1):
+            yield result
@@ -0,0 +1,109 @@
+"""
+批处理流水线
+把 解码 -> 推理 -> 编码/写盘 拆成三个阶段，阶段之间用有界队列连接：
+解码和编码各用一个线程池，推理阶段单独运行，文件与编解码 I/O 可以和模型计算重叠。
+队列满时上游阶段会阻塞等待，内存中同时存在的图片数量不会超过各阶段的队列深度。
+"""
+
+import queue
+import threading
+
+_DONE = object()
+
+
+def _start_threads(count, target, name):
+    threads = [threading.Thread(target=target, name=f"{name}-{i}", daemon=True) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def run_pipeline(items, decode, infer, encode, decode_workers=2, infer_workers=1, encode_workers=2,
+                 decode_depth=8, infer_depth=8, batch_size=1):
+    """按完成顺序逐个产出 (item, result, error)
+
+    decode(item) 在解码线程池中运行，返回解码后的数据；
+    infer(decoded_list) 在推理阶段运行，每次最多收到 batch_size 个解码结果，返回等长的结果列表；
+    encode(item, inferred) 在编码线程池中运行，返回值作为 result 产出。
+    任一阶段抛出异常时，该图片产出 (item, None, error)，不影响其他图片。
+    decode_depth / infer_depth 分别是解码结果队列和推理结果队列的最大长度。
+    """
+    items = list(items)
+    item_iter = iter(items)
+    item_lock = threading.Lock()
+    decoded_q = queue.Queue(max(1, decode_depth))
+    inferred_q = queue.Queue(max(1, infer_depth))
+    results_q = queue.Queue()
+
+    def decode_worker():
+        while True:
+            with item_lock:
+                item = next(item_iter, _DONE)
+            if item is _DONE:
+                return
+            try:
+                decoded_q.put((item, decode(item)))
+            except Exception as e:
+                results_q.put((item, None, e))
+
+    def infer_worker():
+        done = False
+        while not done:
+            first = decoded_q.get()
+            if first is _DONE:
+                return
+            batch = [first]
+            # 队列里已经解码好的图片凑成一批，不等待后续图片
+            while len(batch) < batch_size:
+                try:
+                    nxt = decoded_q.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is _DONE:
+                    done = True
+                    break
+                batch.append(nxt)
+
+            try:
+                outputs = infer([data for _, data in batch])
+            except Exception as e:
+                for item, _ in batch:
+                    results_q.put((item, None, e))
+                continue
+            for (item, _), output in zip(batch, outputs):
+                inferred_q.put((item, output))
+
+    def encode_worker():
+        while True:
+            entry = inferred_q.get()
+            if entry is _DONE:
+                return
+            item, output = entry
+            try:
+                results_q.put((item, encode(item, output), None))
+            except Exception as e:
+                results_q.put((item, None, e))
+
+    def coordinator():
+        # 上游阶段全部结束后，再给下游每个线程发送结束标记
+        for thread in _start_threads(decode_workers, decode_worker, "decode"):
+            thread.join()
+        for _ in range(infer_workers):
+            decoded_q.put(_DONE)
+        for thread in infer_threads:
+            thread.join()
+        for _ in range(encode_workers):
+            inferred_q.put(_DONE)
+        for thread in encode_threads:
+            thread.join()
+        results_q.put(_DONE)
+
+    infer_threads = _start_threads(infer_workers, infer_worker, "infer")
+    encode_threads = _start_threads(encode_workers, encode_worker, "encode")
+    threading.Thread(target=coordinator, name="pipeline", daemon=True).start()
+
+    while True:
+        result = results_q.get()
+        if result is _DONE:
+            return
+        yield result
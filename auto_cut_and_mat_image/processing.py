@@ -0,0 +1,392 @@
+"""
+单张图片的处理流程
+GUI、多进程工作池等批处理入口共用这里的逻辑，不依赖 Tkinter
+"""
+
+import hashlib
+import io
+import math
+import os
+import sys
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import engine_lazy as engine
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# 截头批处理时每组一起送入人脸检测网络的图片数量
+DETECT_BATCH_SIZE = 16
+
+# 人脸检测网络的输入尺寸
+DETECT_SIZE = 300
+# JPEG 解码时可以直接缩小的倍数 (libjpeg DCT 缩放)
+_CV2_REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+_thread_local = threading.local()
+
+# 截头用的解码结果: img 是按 1/factor 缩小解码的 BGR 图像，size 是按 EXIF 方向旋转后的原图尺寸 (宽, 高)
+CropSource = namedtuple("CropSource", ["path", "img", "size", "factor", "is_jpeg"])
+
+
+def resource_path(relative_path):
+    """ 获取资源的绝对路径 """
+    try:
+        # PyInstaller 创建临时文件夹 _MEIPASS
+        base_path = sys._MEIPASS
+    except Exception:
+        base_path = os.path.dirname(__file__)
+
+    return os.path.join(base_path, relative_path)
+
+
+def load_face_net():
+    """加载人脸检测模型"""
+    prototxt_path = resource_path('Face Detector Prototxt.prototxt')
+    caffemodel_path = resource_path('Face Detection Model.caffemodel')
+    return cv2.dnn.readNetFromCaffe(prototxt_path, caffemodel_path)
+
+
+def list_image_files(folder_path):
+    """获取目录及所有子目录中的图片文件"""
+    image_files = []
+    for root, dirs, files in os.walk(folder_path):
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                image_files.append(os.path.join(root, file))
+    return image_files
+
+
+def save_jpeg(img, output_path, dpi, quality=95):
+    """保存为 JPEG，自动创建输出目录
+
+    先写临时文件再替换，中途中断时不会留下写了一半的图片。
+    """
+    dirname = os.path.dirname(output_path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        img.save(tmp_path, 'JPEG', dpi=dpi, quality=quality)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def resize_matting_result(processed_img, target_width, target_height):
+    """把抠图结果缩放到目标尺寸，已经是目标尺寸时直接返回"""
+    if processed_img.size == (target_width, target_height):
+        return processed_img
+    return processed_img.resize((target_width, target_height), Image.LANCZOS)
+
+
+def thread_face_net():
+    """当前线程专用的人脸检测网络；一个 cv2.dnn 网络不能在多个线程中同时使用，每个线程第一次调用时各自加载"""
+    net = getattr(_thread_local, "face_net", None)
+    if net is None:
+        net = _thread_local.face_net = load_face_net()
+    return net
+
+
+def set_crop_threads(workers):
+    """多个检测线程并行时，把 OpenCV 的线程数平分给各个线程，避免线程过多互相争抢；返回之前的线程数"""
+    previous = cv2.getNumThreads()
+    cv2.setNumThreads(max(1, (os.cpu_count() or 1) // max(1, workers)))
+    return previous
+
+
+@contextmanager
+def crop_threads(workers):
+    """在批处理期间调用 set_crop_threads，结束后恢复 OpenCV 原来的线程数
+
+    cv2.setNumThreads 是进程级设置，不恢复的话之后的单张处理也只能用一个线程。
+    """
+    previous = set_crop_threads(workers)
+    try:
+        yield
+    finally:
+        cv2.setNumThreads(previous)
+
+
+def image_info(image_path):
+    """只读文件头，返回 ((宽, 高), 是否为 JPEG)"""
+    with Image.open(image_path) as img:
+        return img.size, img.format == "JPEG"
+
+
+def reduce_factor(size, min_width, min_height, is_jpeg=True):
+    """缩小后宽高仍不小于 (min_width, min_height) 的最大解码缩小倍数；只有 JPEG 能在解码时缩小"""
+    if is_jpeg:
+        for factor in (8, 4, 2):
+            if size[0] // factor >= min_width and size[1] // factor >= min_height:
+                return factor
+    return 1
+
+
+def read_image_cv2(image_path, factor=1):
+    """用 OpenCV 读取 BGR 图像，factor 为解码时的缩小倍数，读取失败时抛出 IOError"""
+    img = cv2.imread(image_path, _CV2_REDUCED_FLAGS[factor])
+    if img is None:
+        raise IOError(f"无法读取图像 {image_path}")
+    return img
+
+
+def detect_face(net, img, confidence):
+    """检测人脸，返回第一个置信度超过阈值的人脸框 (startX, startY, endX, endY)，未检测到时返回 None"""
+    return detect_faces(net, [img], confidence)[0]
+
+
+def oriented_size(size, img, factor=1):
+    """按解码结果的朝向返回原图尺寸 (宽, 高)
+
+    PIL 读到的文件头尺寸不考虑 EXIF 方向，cv2.imread 则会按 EXIF 方向旋转图像；
+    方向为 5-8 的照片解码后宽高互换，这里以解码结果为准。
+    """
+    (h, w) = img.shape[:2]
+    (width, height) = size
+    if (math.ceil(width / factor), math.ceil(height / factor)) != (w, h) and (
+        math.ceil(height / factor), math.ceil(width / factor)
+    ) == (w, h):
+        return height, width
+    return width, height
+
+
+def read_for_detection(image_path):
+    """按检测网络需要的分辨率缩小解码，人脸框仍按原图坐标计算"""
+    size, is_jpeg = image_info(image_path)
+    factor = reduce_factor(size, DETECT_SIZE, DETECT_SIZE, is_jpeg)
+    img = read_image_cv2(image_path, factor)
+    return CropSource(image_path, img, oriented_size(size, img, factor), factor, is_jpeg)
+
+
+def detect_sources(net, sources, confidence):
+    """检测一组 CropSource，返回原图坐标的人脸框"""
+    return detect_faces(net, [src.img for src in sources], confidence, [src.size for src in sources])
+
+
+def detect_faces(net, imgs, confidence, sizes=None):
+    """一次前向检测一组图片，逐张返回第一个置信度超过阈值的人脸框，结果与逐张检测相同
+
+    sizes 为每张图片对应的原图尺寸 (宽, 高)，图片是缩小解码的时候用来把人脸框换算回原图坐标。
+    """
+    if not imgs:
+        return []
+    blob = cv2.dnn.blobFromImages(
+        [cv2.resize(img, (300, 300)) for img in imgs], 1.0, (300, 300), (104.0, 177.0, 123.0)
+    )
+    net.setInput(blob)
+    # 每一行为 [图片序号, 类别, 置信度, x1, y1, x2, y2]，同一张图片的行保持单张检测时的顺序
+    detections = net.forward().reshape(-1, 7)
+
+    boxes = [None] * len(imgs)
+    for row in detections[detections[:, 2] > confidence]:
+        idx = int(row[0])
+        if 0 <= idx < len(imgs) and boxes[idx] is None:
+            if sizes is not None:
+                (w, h) = sizes[idx]
+            else:
+                (h, w) = imgs[idx].shape[:2]
+            box = row[3:7] * np.array([w, h, w, h])
+            boxes[idx] = box.astype("int")
+    return boxes
+
+
+def check_batched_detection(net, imgs, confidence=0.5):
+    """对比分组检测与逐张单独检测的人脸框，返回不一致的图片序号列表"""
+    mismatched = []
+    batched = detect_faces(net, imgs, confidence)
+    for i, img in enumerate(imgs):
+        blob = cv2.dnn.blobFromImage(cv2.resize(img, (300, 300)), 1.0, (300, 300), (104.0, 177.0, 123.0))
+        net.setInput(blob)
+        detections = net.forward()
+        (h, w) = img.shape[:2]
+        expected = None
+        for j in range(0, detections.shape[2]):
+            if detections[0, 0, j, 2] > confidence:
+                expected = (detections[0, 0, j, 3:7] * np.array([w, h, w, h])).astype("int")
+                break
+        if (expected is None) != (batched[i] is None) or (
+            expected is not None and not np.array_equal(expected, batched[i])
+        ):
+            mismatched.append(i)
+    return mismatched
+
+
+def crop_to_target(img, face_box, target_width, target_height, cut_percentage, image_path=""):
+    """从下巴位置截取到图像底部，缩放填满目标尺寸后居中裁剪，返回 PIL 图像"""
+    cropped_img = img  # 默认使用整个图像
+    if face_box is not None:
+        (startX, startY, endX, endY) = face_box
+        chin_y = startY + int(cut_percentage * (endY - startY))
+        # 从下巴位置开始截取到图像底部
+        cropped_img = img[chin_y:, :]
+    else:
+        print(f"警告：在图像 {image_path} 中未检测到人脸，使用原图")
+
+    return fill_crop(cropped_img, target_width, target_height)
+
+
+def _fill_size(original_width, original_height, target_width, target_height):
+    """填满目标尺寸的缩放后尺寸
+
+    int(original * scale) 的浮点误差可能让缩放后的边比目标尺寸小 1 像素，
+    这时按目标尺寸计算，裁剪框不会超出图像。
+    """
+    scale = max(target_width / original_width, target_height / original_height)
+    return max(target_width, int(original_width * scale)), max(target_height, int(original_height * scale))
+
+
+def fill_crop(cropped_img, target_width, target_height):
+    """把 BGR 图像缩放填满目标尺寸后居中裁剪，返回 PIL 图像"""
+    # 计算缩放后的尺寸，使用较大的比例以填满目标尺寸
+    original_height, original_width = cropped_img.shape[:2]
+    new_width, new_height = _fill_size(original_width, original_height, target_width, target_height)
+
+    # 计算裁剪位置（居中裁剪）
+    left = (new_width - target_width) // 2
+    top = (new_height - target_height) // 2
+
+    # 把裁剪框换算回原图坐标，只对保留的区域做一次重采样，构图与先缩放再裁剪相同
+    sx = original_width / new_width
+    sy = original_height / new_height
+    box = (
+        max(0.0, left * sx),
+        max(0.0, top * sy),
+        min(original_width, (left + target_width) * sx),
+        min(original_height, (top + target_height) * sy),
+    )
+
+    # 只转换裁剪框加上 LANCZOS 滤波半径的像素，边缘外的像素不参与计算
+    margin = int(math.ceil(3 * max(sx, sy, 1.0))) + 1
+    x0 = max(0, int(box[0]) - margin)
+    y0 = max(0, int(box[1]) - margin)
+    x1 = min(original_width, int(math.ceil(box[2])) + margin)
+    y1 = min(original_height, int(math.ceil(box[3])) + margin)
+    pil_image = Image.fromarray(cv2.cvtColor(cropped_img[y0:y1, x0:x1], cv2.COLOR_BGR2RGB))
+    box = (box[0] - x0, box[1] - y0, box[2] - x0, box[3] - y0)
+
+    # 裁剪并缩放到目标尺寸
+    return pil_image.resize((target_width, target_height), Image.LANCZOS, box=box)
+
+
+def _truncating_offsets(length, other, target, target_other, limit=3):
+    """从开头截掉多少像素后，int(length * scale) 会截断到比目标尺寸小 1，最多返回 limit 个"""
+    offsets = []
+    for offset in range(length - 1):
+        remaining = length - offset
+        scale = max(target / remaining, target_other / other)
+        if int(remaining * scale) < target:
+            offsets.append(offset)
+            if len(offsets) >= limit:
+                break
+    return offsets
+
+
+def check_crop_geometry(img, target_width, target_height):
+    """对比先缩放再裁剪与直接按原图坐标裁剪缩放的结果，返回最大像素差
+
+    除了整张图片，还检查截掉顶部或左侧若干像素后缩放尺寸会被截断的区域（下巴位置不同，截取高度就不同）。
+    """
+    original_height, original_width = img.shape[:2]
+    regions = [img]
+    regions += [img[top:] for top in _truncating_offsets(original_height, original_width, target_height, target_width)]
+    regions += [img[:, left:] for left in _truncating_offsets(original_width, original_height, target_width, target_height)]
+
+    max_diff = 0
+    for region in regions:
+        pil_image = Image.fromarray(cv2.cvtColor(region, cv2.COLOR_BGR2RGB))
+        new_width, new_height = _fill_size(pil_image.width, pil_image.height, target_width, target_height)
+        left = (new_width - target_width) // 2
+        top = (new_height - target_height) // 2
+        expected = pil_image.resize((new_width, new_height), Image.LANCZOS).crop(
+            (left, top, left + target_width, top + target_height)
+        )
+        actual = fill_crop(region, target_width, target_height)
+        diff = np.abs(np.asarray(expected, dtype=np.int16) - np.asarray(actual, dtype=np.int16))
+        max_diff = max(max_diff, int(diff.max()))
+    return max_diff
+
+
+def crop_source(src, face_box, target_width, target_height, cut_percentage):
+    """按原图坐标的人脸框截头；缩小解码后截取区域仍不小于目标尺寸时不再解码原图"""
+    (width, height) = src.size
+    chin_y = 0
+    if face_box is not None:
+        chin_y = face_box[1] + int(cut_percentage * (face_box[3] - face_box[1]))
+    region_height = max(1, height - chin_y)
+    scale = max(target_width / width, target_height / region_height)
+    factor = reduce_factor(
+        (width, region_height), math.ceil(width * scale), math.ceil(region_height * scale), src.is_jpeg
+    )
+
+    img = src.img if factor == src.factor else read_image_cv2(src.path, factor)
+    if face_box is not None and factor != 1:
+        (h, w) = img.shape[:2]
+        face_box = (np.asarray(face_box) * np.array([w / width, h / height, w / width, h / height])).astype("int")
+    return crop_to_target(img, face_box, target_width, target_height, cut_percentage, src.path)
+
+
+def crop_path(net, image_path, target_width, target_height, confidence, cut_percentage):
+    """缩小解码检测人脸，再按需要的分辨率截头，返回 PIL 图像"""
+    src = read_for_detection(image_path)
+    face_box = detect_sources(net, [src], confidence)[0]
+    return crop_source(src, face_box, target_width, target_height, cut_percentage)
+
+
+def crop_image(net, img, target_width, target_height, confidence, cut_percentage, image_path=""):
+    """人脸检测 + 裁剪的完整流程"""
+    face_box = detect_face(net, img, confidence)
+    return crop_to_target(img, face_box, target_width, target_height, cut_percentage, image_path)
+
+
+def crop_file(net, image_path, target_width, target_height, dpi, confidence, cut_percentage, output_path=None):
+    """裁剪并保存，output_path 为空时覆盖原始图像"""
+    final_img = crop_path(net, image_path, target_width, target_height, confidence, cut_percentage)
+    save_jpeg(final_img, output_path or image_path, dpi, quality=100)
+
+
+def output_path_for(image_path, input_root, output_root):
+    """在输出目录中保持与输入目录相同的相对路径"""
+    return os.path.join(output_root, os.path.relpath(image_path, input_root))
+
+
+def open_image(image_path, min_size=None):
+    """打开并立即解码图片，让解码发生在调用线程中，返回 (图像, 文件内容哈希)
+
+    给出 min_size (宽, 高) 时，JPEG 在解码时直接缩小到不小于 min_size 的最小尺寸。
+    文件只读取一次，哈希与 job_journal.file_digest 相同；把它作为 source_digest 传给抠图函数，
+    遮罩缓存不受缩小解码的影响。图像被改动过时不要再传这个哈希。
+    """
+    with open(image_path, "rb") as f:
+        data = f.read()
+    img = Image.open(io.BytesIO(data))
+    if min_size is not None:
+        img.draft(img.mode, min_size)
+    img.load()
+    return img, hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def matte_image(img, target_width, target_height, tier=None, tol=None, source_digest=None):
+    """使用 remove_bg_mult 抠图，直接在目标尺寸上合成，返回 (结果图像, 实际使用的轮数)"""
+    return engine.remove_bg_mult(img, tol=tol, return_passes=True, tier=tier, target_size=(target_width, target_height),
+                                 source_digest=source_digest)
+
+
+def matte_file(image_path, target_width, target_height, dpi, output_path=None, tier=None, tol=None):
+    """抠图并保存，output_path 为空时覆盖原始图像，返回实际使用的轮数"""
+    # 输出比原图小时，按目标尺寸缩小解码
+    img, digest = open_image(image_path, (target_width, target_height))
+    resized_img, passes_used = matte_image(img, target_width, target_height, tier, tol, digest)
+    save_jpeg(resized_img, output_path or image_path, dpi)
+    return passes_used
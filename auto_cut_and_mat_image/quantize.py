@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+U2NET INT8 量化脚本
+用自己的图片做训练后静态量化（FX graph mode），生成 CPU 推理用的 INT8 模型，
+并输出与 FP32 模型的遮罩 IoU 对比报告。
+
+用法: python quantize.py 校准图片目录 [--eval-dir 评估图片目录] [--num 64] [--tier full|lite]
+生成的模型保存为 ckpt/u2net_int8.pt（lite 为 ckpt/u2netp_int8.pt），之后调用
+engine.set_precision("int8") 即可使用。
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+import engine_lazy as engine
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def list_images(folder_path, limit=None):
+    """递归列出目录中的图片文件"""
+    image_files = []
+    for root, dirs, files in os.walk(folder_path):
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                image_files.append(os.path.join(root, file))
+    image_files.sort()
+    if limit is not None:
+        image_files = image_files[:limit]
+    return image_files
+
+
+def load_inputs(image_files):
+    """把图片预处理成模型输入 (1, 3, 320, 320)，与引擎推理时的预处理一致"""
+    for image_path in image_files:
+        image = Image.open(image_path).convert("RGB")
+        yield torch.from_numpy(engine.preprocess_fast(image)).unsqueeze(0)
+
+
+def quantize_model(calib_files, backend="fbgemm", tier=None):
+    """在校准图片上统计激活范围，返回 INT8 模型"""
+    torch.backends.quantized.engine = backend
+    # 量化前不折叠 BN，prepare_fx 会自己融合 conv + bn + relu
+    net = engine.build_model(optimize=False, tier=tier)
+    example_inputs = (torch.rand(1, 3, 320, 320),)
+    prepared = prepare_fx(net, get_default_qconfig_mapping(backend), example_inputs)
+
+    print(f"正在校准，共 {len(calib_files)} 张图片...")
+    with torch.no_grad():
+        for inputs in load_inputs(calib_files):
+            prepared(inputs)
+
+    return convert_fx(prepared)
+
+
+def save_model(qmodel, output_path):
+    """保存为 TorchScript，加载时不需要重新走量化流程"""
+    with torch.no_grad():
+        traced = torch.jit.trace(qmodel, torch.rand(1, 3, 320, 320))
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    torch.jit.save(traced, output_path)
+    print(f"INT8 模型已保存: {output_path}")
+
+
+def mask_iou(a, b, threshold=0.5):
+    """两张遮罩在阈值二值化后的 IoU"""
+    a = a >= threshold
+    b = b >= threshold
+    union = np.logical_or(a, b).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(a, b).sum() / union)
+
+
+def iou_report(fp32_model, int8_model, image_files, threshold=0.5):
+    """对比 FP32 与 INT8 模型在每张图片上的遮罩 IoU"""
+    ious = []
+    with torch.no_grad():
+        for image_path, inputs in zip(image_files, load_inputs(image_files)):
+            expected = engine.norm_pred(fp32_model(inputs)).numpy()
+            actual = engine.norm_pred(int8_model(inputs)).numpy()
+            ious.append(mask_iou(expected, actual, threshold))
+            print(f"{os.path.basename(image_path)}: IoU={ious[-1]:.4f}")
+
+    report = {
+        "count": len(ious),
+        "mean_iou": float(np.mean(ious)) if ious else None,
+        "min_iou": float(np.min(ious)) if ious else None,
+    }
+    if ious:
+        print(f"共 {report['count']} 张，平均 IoU={report['mean_iou']:.4f}，最小 IoU={report['min_iou']:.4f}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="U2NET INT8 训练后静态量化")
+    parser.add_argument("calib_dir", help="校准图片目录")
+    parser.add_argument("--eval-dir", help="评估 IoU 用的图片目录，默认使用校准目录")
+    parser.add_argument("--num", type=int, default=64, help="最多使用的校准图片数量")
+    parser.add_argument("--tier", choices=sorted(engine.MODEL_TIERS), default="full", help="模型档位")
+    parser.add_argument("--output", help="INT8 模型保存路径，默认保存到 ckpt 目录")
+    parser.add_argument("--backend", default="fbgemm", help="量化后端 (fbgemm / x86 / qnnpack)")
+    args = parser.parse_args()
+
+    calib_files = list_images(args.calib_dir, args.num)
+    if not calib_files:
+        print(f"错误：目录中没有图片 {args.calib_dir}")
+        return 1
+
+    qmodel = quantize_model(calib_files, args.backend, args.tier)
+    save_model(qmodel, args.output or engine.get_int8_model_path(args.tier))
+
+    eval_files = list_images(args.eval_dir or args.calib_dir, args.num)
+    iou_report(engine.build_model(tier=args.tier), qmodel, eval_files)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+本机抠图 HTTP 服务
+同一台机器上的其他服务可以通过 HTTP 调用抠图引擎。并发请求由微批处理器合并成一次
+U2NET 批量推理：第一个请求到达后最多等待 max_wait_ms，或凑满 max_batch 张就开始推理。
+
+接口:
+    POST /matte?format=png|jpeg|mask[&mask_size=full|low]   请求体为图片文件的原始字节
+        png  -> 透明背景的 RGBA PNG
+        jpeg -> 白色背景的 JPEG
+        mask -> 灰度遮罩 PNG，mask_size=low 时返回模型分辨率的原始遮罩
+        响应头 X-Matting-Passes 为这张图片实际使用的抠图轮数
+    GET /health   返回批处理统计 (JSON)
+
+用法: python server.py [--port 8765] [--max-batch 8] [--max-wait-ms 10] [--tier full|lite] [--tol 0.002]
+      或 batchcut serve ...
+"""
+
+import argparse
+import io
+import json
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+import engine_lazy as engine
+
+FORMATS = ("png", "jpeg", "mask")
+CONTENT_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "mask": "image/png"}
+
+
+class MicroBatcher:
+    """把并发提交的图片合并成批，在单独的线程中计算遮罩"""
+
+    def __init__(self, max_batch=8, max_wait_ms=10, tier=None, passes=4, mode=None, tol=None):
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000
+        self.tier = tier
+        self.passes = passes
+        self.mode = mode
+        self.tol = tol
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.images = 0
+        self.passes_total = 0
+        self._thread = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, image):
+        """提交一张图片，返回 Future，结果为 (低分辨率 L 模式遮罩, 实际使用的轮数)"""
+        future = Future()
+        self._queue.put((image, future))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            images = [image for image, _ in batch]
+            try:
+                masks, passes_used = engine.remove_bg_mult_masks(
+                    images, batch_size=self.max_batch, mode=self.mode, passes=self.passes,
+                    tol=self.tol, tier=self.tier,
+                )
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            with self._stats_lock:
+                self.batches += 1
+                self.images += len(batch)
+                self.passes_total += sum(passes_used)
+            for (_, future), mask, used in zip(batch, masks, passes_used):
+                future.set_result((mask, used))
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "batches": self.batches,
+                "images": self.images,
+                "mean_batch_size": self.images / self.batches if self.batches else 0.0,
+                "mean_passes": self.passes_total / self.images if self.images else 0.0,
+                "queued": self._queue.qsize(),
+            }
+
+
+def encode_result(image, mask, fmt="png", mask_size="full"):
+    """把遮罩应用到原图并编码为响应字节"""
+    buffer = io.BytesIO()
+    if fmt == "mask":
+        if mask_size != "low":
+            mask = mask.resize(image.size, Image.LANCZOS)
+        mask.save(buffer, "PNG")
+    elif fmt == "jpeg":
+        engine._composite_white(image, mask).save(buffer, "JPEG", quality=95)
+    else:
+        img_out = image.convert("RGBA")
+        img_out.putalpha(mask.resize(image.size, Image.LANCZOS))
+        img_out.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class MattingHandler(BaseHTTPRequestHandler):
+    server_version = "BatchCut"
+    # 由 make_server 设置
+    batcher = None
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self._send(status, json.dumps({"error": message}, ensure_ascii=False).encode("utf-8"))
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            self._send_error(404, "未知的接口")
+            return
+        stats = dict(self.batcher.stats(), model_loaded=engine.is_model_loaded(self.batcher.tier))
+        self._send(200, json.dumps(stats).encode("utf-8"))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/matte":
+            self._send_error(404, "未知的接口")
+            return
+        query = parse_qs(url.query)
+        fmt = query.get("format", ["png"])[0]
+        mask_size = query.get("mask_size", ["full"])[0]
+        if fmt not in FORMATS:
+            self._send_error(400, f"未知的输出格式: {fmt}")
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        if length <= 0:
+            self._send_error(400, "请求体为空")
+            return
+        try:
+            image = Image.open(io.BytesIO(self.rfile.read(length)))
+            image.load()
+        except Exception as e:
+            self._send_error(400, f"无法读取图像: {e}")
+            return
+
+        try:
+            mask, passes_used = self.batcher.submit(image).result()
+            body = encode_result(image, mask, fmt, mask_size)
+        except Exception as e:
+            self._send_error(500, f"{type(e).__name__}: {e}")
+            return
+        self._send(200, body, CONTENT_TYPES[fmt], {"X-Matting-Passes": str(passes_used)})
+
+    def log_message(self, format, *args):
+        # 高并发时逐条打印请求日志会拖慢服务
+        pass
+
+
+def make_server(host="127.0.0.1", port=8765, max_batch=8, max_wait_ms=10, tier=None, passes=4, mode=None,
+                tol=None):
+    """创建服务器，每个服务器有自己的微批处理器"""
+    batcher = MicroBatcher(max_batch, max_wait_ms, tier, passes, mode, tol)
+    handler = type("BoundMattingHandler", (MattingHandler,), {"batcher": batcher})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    return httpd
+
+
+def serve(host="127.0.0.1", port=8765, max_batch=8, max_wait_ms=10, tier=None, passes=4, mode=None,
+          threads=None, warmup_passes=2, tol=None):
+    """加载并预热模型后开始服务，直到 Ctrl+C"""
+    if threads:
+        engine.set_num_threads(threads)
+    engine.load_model(tier)
+    if warmup_passes:
+        engine.warmup(warmup_passes, batch_size=max_batch, tier=tier)
+
+    httpd = make_server(host, port, max_batch, max_wait_ms, tier, passes, mode, tol)
+    print(f"抠图服务已启动: http://{host}:{port}/matte (max_batch={max_batch}, max_wait={max_wait_ms}ms)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+    return 0
+
+
+def add_arguments(parser):
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址，默认只接受本机请求")
+    parser.add_argument("--port", type=int, default=8765, help="监听端口")
+    parser.add_argument("--max-batch", type=int, default=8, help="每批最多合并的图片数量")
+    parser.add_argument("--max-wait-ms", type=float, default=10, help="凑批时最多等待的毫秒数")
+    parser.add_argument("--tier", choices=sorted(engine.MODEL_TIERS), default=engine.get_model_tier(), help="模型档位")
+    parser.add_argument("--passes", type=int, default=4, help="最多抠图轮数")
+    parser.add_argument("--tol", type=float,
+                        help="收敛阈值 (0~1)，两轮之间 alpha 的平均变化小于该值时提前停止；默认总是跑满 --passes 轮")
+    parser.add_argument("--mode", choices=engine.MATTING_MODES,
+                        help="抠图方式，默认使用质量档位对应的方式 (quality: pil，fast: guided)")
+    parser.add_argument("--threads", type=int, help="推理线程数")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本机抠图 HTTP 服务")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    return serve(args.host, args.port, args.max_batch, args.max_wait_ms, args.tier, args.passes, args.mode,
+                 args.threads, tol=args.tol)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
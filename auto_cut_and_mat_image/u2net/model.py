@@ -21,6 +21,30 @@ class REBNCONV(nn.Module):
 
         return xout
 
+    @torch.no_grad()
+    def fuse(self):
+        # fold the BatchNorm running statistics into the conv weights (inference only)
+        if isinstance(self.bn_s1, nn.Identity):
+            return
+
+        bn = self.bn_s1
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        bias = self.conv_s1.bias
+        if bias is None:
+            bias = torch.zeros_like(bn.running_mean)
+
+        self.conv_s1.weight.mul_(scale.view(-1, 1, 1, 1))
+        self.conv_s1.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+        self.bn_s1 = nn.Identity()
+
+
+def fuse_conv_bn(net):
+    # fold conv_s1 + bn_s1 of every REBNCONV in net, in place; net must be in eval mode
+    for m in net.modules():
+        if isinstance(m, REBNCONV):
+            m.fuse()
+    return net
+
 
 ### RSU-7 ###
 class RSU7(nn.Module):  # UNet07DRES(nn.Module):
@@ -361,6 +385,9 @@ class U2NET(nn.Module):
 
         self.outconv = nn.Conv2d(6, 1, 1)
 
+        # when True, forward returns only the fused output sigmoid(d0) instead of all seven side outputs
+        self.inference_only = False
+
     def forward(self, x):
 
         hx = x
@@ -424,6 +451,9 @@ class U2NET(nn.Module):
 
         d0 = self.outconv(torch.cat((d1, d2, d3, d4, d5, d6), 1))
 
+        if self.inference_only:
+            return torch.sigmoid(d0)
+
         return (
             torch.sigmoid(d0),
             torch.sigmoid(d1),
@@ -479,6 +509,9 @@ class U2NETP(nn.Module):
 
         self.outconv = nn.Conv2d(6, 1, 1)
 
+        # when True, forward returns only the fused output sigmoid(d0) instead of all seven side outputs
+        self.inference_only = False
+
     def forward(self, x):
 
         hx = x
@@ -543,6 +576,9 @@ class U2NETP(nn.Module):
         d0 = self.outconv(torch.cat((d1, d2, d3, d4, d5, d6), 1))
         # d00 = d0 + self.refconv(d0)
 
+        if self.inference_only:
+            return torch.sigmoid(d0)
+
         return (
             torch.sigmoid(d0),
             torch.sigmoid(d1),